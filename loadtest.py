@@ -0,0 +1,384 @@
+"""Нагрузочный тест бота без MOEX и Telegram.
+
+Поднимает локальные заглушки MOEX ALGOPACK (растущий alerts.json) и Telegram Bot API
+(запись сообщений, flood control с retry_after, поток /start и callback-обновлений),
+запускает main.py против них и печатает отчет: задержку от появления алерта до поста
+в канале, p50/p99 ответов обработчиков и пропускную способность.
+
+Пример:
+    python loadtest.py --duration 120 --alert-rate 20 --users 5000 --update-rate 200
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from aiohttp import web
+
+ALERT_TYPES = [
+    'vol_s_99_9_pctl', 'vol_b_99_9_pctl', 'vol_s_99_pctl', 'vol_b_99_pctl',
+    'vol_s_95_pctl', 'vol_b_95_pctl', 'pr_change_99_9_pctl-', 'pr_change_99_9_pctl+',
+    'vol_max', 'pr_change_max',
+]
+CHANNEL_ID = -1001000000001
+ADMIN_ID = 1
+SECURITIES_COUNT = 5000  # Сколько тикеров LT* отдает справочник ISS
+TICKER_RE = re.compile(r'Тикер:</b> (LT\d+)')
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def format_latency(title, values):
+    if not values:
+        return f"{title}: нет данных"
+    return (
+        f"{title}: n={len(values)} p50={percentile(values, 50) * 1000:.0f} мс "
+        f"p99={percentile(values, 99) * 1000:.0f} мс max={max(values) * 1000:.0f} мс"
+    )
+
+
+class MoexStub:
+    """Заглушка MOEX ALGOPACK: alerts.json за день, который растет с заданной скоростью"""
+
+    def __init__(self, alert_rate):
+        self.alert_rate = alert_rate
+        self.rows = []
+        self.appeared = {}  # тикер -> время появления алерта
+        self.requests = 0
+
+    def add_alert(self):
+        now = datetime.now()
+        ticker = f"LT{len(self.rows):06d}"
+        change = round(random.uniform(-3, 3), 2)
+        details = [{
+            'm_15': [0, 0, random.randint(0, 50), random.randint(0, 50), change],
+            'vol_b': random.randint(1, 10000),
+            'vol_s': random.randint(1, 10000),
+        }]
+        self.rows.append([
+            now.strftime('%Y-%m-%d'),
+            now.strftime('%H:%M:%S'),
+            ticker,
+            random.choice(ALERT_TYPES),
+            1000,
+            random.randint(1000, 100000),
+            json.dumps(details),
+            now.strftime('%Y-%m-%d %H:%M:%S'),
+        ])
+        self.appeared[ticker] = time.time()
+
+    async def generate(self):
+        started = time.time()
+        while True:
+            # Алерты появляются пачками неравного размера, в среднем alert_rate в секунду
+            await asyncio.sleep(random.uniform(0.1, 1.0))
+            due = int(self.alert_rate * (time.time() - started)) - len(self.rows)
+            for _ in range(due):
+                self.add_alert()
+
+    async def handle_alerts(self, request):
+        self.requests += 1
+        return web.json_response({'data': {'data': self.rows}})
+
+    async def handle_securities(self, request):
+        # Справочник бумаг: по строке на тикер, который может появиться в алертах
+        self.requests += 1
+        data = [
+            [f"LT{i:06d}", f"Нагрузочный тест {i}", 10, 0.01, round(random.uniform(10, 5000), 2), 'LT']
+            for i in range(SECURITIES_COUNT)
+        ]
+        return web.json_response({'securities': {
+            'columns': ['SECID', 'SHORTNAME', 'LOTSIZE', 'MINSTEP', 'PREVPRICE', 'SECTORID'],
+            'data': data,
+        }})
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get('/iss/datashop/algopack/eq/alerts.json', self.handle_alerts)
+        app.router.add_get('/iss/engines/stock/markets/shares/boards/{board}/securities.json', self.handle_securities)
+        return app
+
+
+class TelegramStub:
+    """Заглушка Telegram Bot API: отдает обновления, записывает ответы бота, имитирует flood control"""
+
+    def __init__(self, moex, users, update_rate, callback_share, flood_limit, retry_after):
+        self.moex = moex
+        self.users = users
+        self.update_rate = update_rate
+        self.callback_share = callback_share
+        self.flood_limit = flood_limit
+        self.retry_after = retry_after
+
+        self.updates = []
+        self.handed_out = 0  # Сколько обновлений уже роздано экземплярам бота
+        self.new_updates = asyncio.Event()
+        self.delivered = {}  # chat_id -> время выдачи последнего обновления боту
+        self.handler_latency = []
+        self.alert_latency = []
+        self.posted = set()
+        self.duplicate_posts = 0
+        self.chat_sends = {}  # chat_id -> времена отправок за последнюю минуту
+        self.flood_errors = 0
+        self.calls = {}
+        self.message_id = 0
+
+    # --- генерация обновлений ---
+    def make_update(self, user_id):
+        update_id = len(self.updates) + 1
+        user = {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}', 'username': f'user{user_id}'}
+        chat = {'id': user_id, 'type': 'private'}
+        message = {'message_id': update_id, 'date': int(time.time()), 'chat': chat, 'from': user}
+
+        if random.random() < self.callback_share:
+            return {
+                'update_id': update_id,
+                'callback_query': {
+                    'id': str(update_id),
+                    'from': user,
+                    'chat_instance': str(user_id),
+                    'data': random.choice(['activate_trial', 'buy_subscription', 'back_to_start']),
+                    'message': {**message, 'text': 'menu', 'from': {'id': 1, 'is_bot': True, 'first_name': 'bot'}},
+                },
+            }
+        message.update({'text': '/start', 'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}]})
+        return {'update_id': update_id, 'message': message}
+
+    async def inject(self):
+        interval = 1 / self.update_rate
+        for user_id in range(1_000_000, 1_000_000 + self.users):
+            self.updates.append(self.make_update(user_id))
+            self.new_updates.set()
+            await asyncio.sleep(interval)
+
+    # --- Bot API ---
+    def message(self, chat_id, text=''):
+        self.message_id += 1
+        chat_type = 'channel' if chat_id < 0 else 'private'
+        return {'message_id': self.message_id, 'date': int(time.time()), 'chat': {'id': chat_id, 'type': chat_type}, 'text': text}
+
+    def record_reply(self, chat_id):
+        delivered = self.delivered.pop(chat_id, None)
+        if delivered is not None:
+            self.handler_latency.append(time.time() - delivered)
+
+    def flood_limited(self, chat_id):
+        now = time.time()
+        sends = [t for t in self.chat_sends.get(chat_id, []) if now - t < 60]
+        if len(sends) >= self.flood_limit:
+            self.chat_sends[chat_id] = sends
+            return True
+        sends.append(now)
+        self.chat_sends[chat_id] = sends
+        return False
+
+    def take_updates(self, offset, limit):
+        # Каждое обновление получает один экземпляр бота - как при webhook за балансировщиком
+        start = max(offset - 1, self.handed_out)
+        pending = self.updates[start:start + limit]
+        self.handed_out = start + len(pending)
+        return pending
+
+    async def get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        timeout = min(float(params.get('timeout') or 0), 1.0)
+        pending = self.take_updates(offset, limit)
+        if not pending and timeout:
+            self.new_updates.clear()
+            try:
+                await asyncio.wait_for(self.new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            pending = self.take_updates(offset, limit)
+
+        now = time.time()
+        for update in pending:
+            chat_id = (update.get('message') or update['callback_query'])['from']['id']
+            self.delivered.setdefault(chat_id, now)
+        return pending
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        params = dict(await request.post())
+        if not params and request.can_read_body and request.content_type == 'application/json':
+            params = await request.json()
+        self.calls[method] = self.calls.get(method, 0) + 1
+        chat_id = int(params['chat_id']) if params.get('chat_id') else None
+
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Load test bot', 'username': 'loadtest_bot'}
+        elif method == 'getUpdates':
+            result = await self.get_updates(params)
+        elif method in ('sendMessage', 'copyMessage', 'sendDocument'):
+            if self.flood_limited(chat_id):
+                self.flood_errors += 1
+                return web.json_response({
+                    'ok': False,
+                    'error_code': 429,
+                    'description': f'Too Many Requests: retry after {self.retry_after}',
+                    'parameters': {'retry_after': self.retry_after},
+                })
+            text = params.get('text', '')
+            match = TICKER_RE.search(text)
+            if match and match.group(1) in self.posted:
+                self.duplicate_posts += 1
+            elif match:
+                self.posted.add(match.group(1))
+                appeared = self.moex.appeared.get(match.group(1))
+                if appeared:
+                    self.alert_latency.append(time.time() - appeared)
+            self.record_reply(chat_id)
+            result = self.message(chat_id, text)
+        elif method == 'editMessageText':
+            self.record_reply(chat_id)
+            result = self.message(chat_id, params.get('text', ''))
+        elif method == 'answerCallbackQuery':
+            result = True
+        elif method == 'createChatInviteLink':
+            result = {
+                'invite_link': f'https://t.me/+{random.randbytes(8).hex()}',
+                'creator': {'id': 1, 'is_bot': True, 'first_name': 'bot'},
+                'creates_join_request': False,
+                'is_primary': False,
+                'is_revoked': False,
+            }
+        else:
+            # deleteWebhook, banChatMember, unbanChatMember и прочие - просто успех
+            result = True
+
+        return web.json_response({'ok': True, 'result': result})
+
+    def app(self):
+        app = web.Application()
+        app.router.add_route('*', '/bot{token}/{method}', self.handle)
+        return app
+
+
+async def start_site(app, port):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', port)
+    await site.start()
+    return runner
+
+
+def current_leader(db_path):
+    conn = sqlite3.connect(db_path)
+    row = conn.execute("SELECT holder FROM leader_lease WHERE name = 'pollers'").fetchone()
+    conn.close()
+    return row[0] if row else None
+
+
+async def run(args):
+    moex = MoexStub(args.alert_rate)
+    telegram = TelegramStub(
+        moex, args.users, args.update_rate, args.callback_share, args.flood_limit, args.retry_after
+    )
+    runners = [
+        await start_site(moex.app(), args.moex_port),
+        await start_site(telegram.app(), args.telegram_port),
+    ]
+
+    db_dir = tempfile.mkdtemp(prefix='moex_loadtest_')
+    env = dict(
+        os.environ,
+        MOEX_API_URL=f'http://127.0.0.1:{args.moex_port}',
+        TELEGRAM_API_URL=f'http://127.0.0.1:{args.telegram_port}',
+        ALERTS_DB_PATH=os.path.join(db_dir, 'alerts_bot.db'),
+        STATE_SNAPSHOT_PATH=os.path.join(db_dir, 'bot_state.json'),
+        MOEX_ISS_URL=f'http://127.0.0.1:{args.moex_port}',
+        INSTRUMENTS_PATH=os.path.join(db_dir, 'instruments.json'),
+        CHECK_INTERVAL=str(args.poll_interval),
+        # Тестовые значения: отрицательный ID - канал, положительный - администратор
+        TELEGRAM_BOT_TOKEN='123456:LOADTEST',
+        ALERTS_CHANNEL_ID=str(CHANNEL_ID),
+        ADMIN_ID=str(ADMIN_ID),
+    )
+    # Несколько экземпляров делят базу и снимок; заглушка раздает обновления тому, кто первым спросил
+    bots = {}
+    for i in range(args.instances):
+        instance_id = f'bot{i}'
+        bot_log = open(os.path.join(db_dir, f'{instance_id}.log'), 'w')
+        bot_process = subprocess.Popen(
+            [sys.executable, args.bot], env=dict(env, INSTANCE_ID=instance_id),
+            stdout=bot_log, stderr=subprocess.STDOUT
+        )
+        bots[instance_id] = (bot_process, bot_log)
+        print(f"Бот {instance_id} запущен (pid {bot_process.pid}), лог и база: {db_dir}")
+
+    started = time.time()
+    tasks = [asyncio.create_task(moex.generate()), asyncio.create_task(telegram.inject())]
+    try:
+        if args.failover_after:
+            await asyncio.sleep(args.failover_after)
+            leader = current_leader(env['ALERTS_DB_PATH'])
+            if leader in bots:
+                # Аварийное завершение: аренда не освобождается, резервный ждет ее истечения
+                bots[leader][0].kill()
+                print(f"Лидер {leader} остановлен на {time.time() - started:.0f} сек")
+        await asyncio.sleep(args.duration - (time.time() - started))
+    finally:
+        for task in tasks:
+            task.cancel()
+        # Заглушки должны отвечать, пока бот корректно завершает polling
+        for bot_process, _ in bots.values():
+            bot_process.terminate()
+        for bot_process, bot_log in bots.values():
+            try:
+                await asyncio.to_thread(bot_process.wait, 10)
+            except subprocess.TimeoutExpired:
+                bot_process.kill()
+            bot_log.close()
+        for runner in runners:
+            await runner.cleanup()
+    elapsed = time.time() - started
+
+    channel_posts = len(telegram.posted)
+    print()
+    print(f"Длительность: {elapsed:.0f} сек")
+    print(f"Алертов сгенерировано: {len(moex.rows)}, опубликовано в канале: {channel_posts}, запросов к MOEX: {moex.requests}")
+    print(format_latency("Алерт -> пост в канале", telegram.alert_latency))
+    print(f"Пропускная способность канала: {channel_posts / elapsed:.2f} постов/сек")
+    print(f"Повторных постов одного алерта: {telegram.duplicate_posts}")
+    print(f"Обновлений отправлено боту: {len(telegram.updates)}, с ответом: {len(telegram.handler_latency)}")
+    print(format_latency("Ответ обработчиков", telegram.handler_latency))
+    print(f"Пропускная способность обработчиков: {len(telegram.handler_latency) / elapsed:.1f} ответов/сек")
+    print(f"Ответов 429 (retry_after): {telegram.flood_errors}")
+    print("Вызовы Bot API: " + ', '.join(f"{method}={count}" for method, count in sorted(telegram.calls.items())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота с локальными заглушками MOEX и Telegram")
+    parser.add_argument('--bot', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py'))
+    parser.add_argument('--duration', type=int, default=60, help="длительность теста, сек")
+    parser.add_argument('--alert-rate', type=float, default=5, help="новых алертов MOEX в секунду")
+    parser.add_argument('--poll-interval', type=int, default=5, help="CHECK_INTERVAL бота, сек")
+    parser.add_argument('--users', type=int, default=1000, help="сколько пользователей пишут боту")
+    parser.add_argument('--update-rate', type=float, default=50, help="обновлений в секунду")
+    parser.add_argument('--callback-share', type=float, default=0.3, help="доля callback-обновлений")
+    parser.add_argument('--flood-limit', type=int, default=20, help="сообщений в минуту в один чат до ответа 429")
+    parser.add_argument('--retry-after', type=int, default=3, help="retry_after в ответе 429, сек")
+    parser.add_argument('--instances', type=int, default=1, help="сколько экземпляров бота запустить на общей базе")
+    parser.add_argument('--failover-after', type=int, default=0, help="через сколько секунд аварийно остановить лидера")
+    parser.add_argument('--moex-port', type=int, default=8081)
+    parser.add_argument('--telegram-port', type=int, default=8082)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
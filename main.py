@@ -1,43 +1,233 @@
+import io
+import copy
 import os
+import sys
 import json
+import pstats
+import marshal
+import threading
+import queue
+import atexit
+import logging
+import logging.handlers
 from aiogram.types import Message
 import asyncio
+import time
+import heapq
+import itertools
+import html
+from collections import deque, namedtuple
 from datetime import datetime, timedelta
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, BufferedInputFile
 from aiogram.utils.keyboard import InlineKeyboardBuilder
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiohttp import web
 import requests
 import random
+import socket
 import string
 import sqlite3
 
 # Конфигурация
-MOEX_TOKEN = ''
-TELEGRAM_BOT_TOKEN = ''
-ALERTS_CHANNEL_ID =   # Числовой ID канала
-ADMIN_ID =   # Ваш ID в Telegram
+# Параметры развертывания задаются переменными окружения (loadtest.py подставляет через них заглушки)
+MOEX_TOKEN = os.getenv('MOEX_TOKEN', '')
+TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN', '')
+ALERTS_CHANNEL_ID = int(os.getenv('ALERTS_CHANNEL_ID', '0'))  # Числовой ID канала
+ADMIN_ID = int(os.getenv('ADMIN_ID', '0'))  # Ваш ID в Telegram
+MOEX_API_URL = os.getenv('MOEX_API_URL', 'https://apim.moex.com')
+MOEX_ISS_URL = os.getenv('MOEX_ISS_URL', 'https://iss.moex.com')  # Публичный ISS для справочника бумаг
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')  # Свой сервер Bot API, по умолчанию api.telegram.org
+DB_PATH = os.getenv('ALERTS_DB_PATH', 'alerts_bot.db')
+CHECK_INTERVAL = int(os.getenv('CHECK_INTERVAL', '60'))  # Интервал проверки алертов в секундах
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')  # Уровень логирования: DEBUG, INFO, WARNING, ERROR
+SNAPSHOT_PATH = os.getenv('STATE_SNAPSHOT_PATH', 'bot_state.json')  # Снимок состояния для теплого перезапуска
+INSTRUMENTS_PATH = os.getenv('INSTRUMENTS_PATH', 'instruments.json')  # Справочник бумаг для холодного старта
+INSTANCE_ID = os.getenv('INSTANCE_ID') or f"{socket.gethostname()}:{os.getpid()}"  # Имя экземпляра в аренде лидера
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # Публичный URL webhook; без него бот работает через polling
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')  # Проверка заголовка X-Telegram-Bot-Api-Secret-Token
+
 PAYMENT_PHONE = '+79998887766'  # Номер для оплаты
 TRIAL_PERIOD_HOURS = 24  # Продолжительность триального периода
+BULK_DB_CHUNK_SIZE = 100  # Сколько пользователей обрабатываем в одной транзакции
+TELEGRAM_CONCURRENCY = 10  # Одновременных запросов к Telegram при массовых операциях
+TELEGRAM_RATE_LIMIT = 25  # Запросов к Telegram в секунду при массовых операциях
+BROADCAST_BATCH_SIZE = 200  # Сколько получателей рассылки выбираем из БД за один запрос
+STATS_CHANGES_HISTORY = 100  # Сколько последних изменений цены храним по каждому тикеру
+ALERT_QUEUE_MAX_SIZE = 50  # При большей очереди малозначимые алерты сбрасываются в сводку
+ALERT_QUEUE_MAX_AGE = 120  # Через сколько секунд ожидания малозначимый алерт сбрасывается в сводку
+LOG_QUEUE_SIZE = 10000  # Максимум записей лога в очереди, лишние отбрасываются
+LOG_RATE_LIMIT_INTERVAL = 60  # Окно ограничения повторяющихся сообщений лога, секунд
+LOG_RATE_LIMIT_BURST = 20  # Сколько одинаковых сообщений за окно пишем полностью
+LOG_SAMPLE_EVERY = 50  # Сверх лимита пишем каждое N-е одинаковое сообщение
+INSTRUMENTS_BOARD = 'TQBR'  # Режим торгов, из которого берем справочник бумаг
+INSTRUMENTS_TTL_HOURS = 24  # Справочник обновляется с новым торговым днем или по истечении TTL
+LEADER_LEASE_TTL = 15  # Через сколько секунд без продления аренду лидера может забрать другой экземпляр
+LEADER_RENEW_INTERVAL = 3  # Как часто лидер продлевает аренду, а резервные экземпляры пробуют ее захватить
+ENTITLEMENT_CACHE_TTL = 300  # Сколько секунд доверяем закэшированной проверке подписки
+ALERT_CURSOR_MARGIN = 300  # Алерты старше курсора на столько секунд не разбираем повторно
+PROFILE_MAX_SECONDS = 600  # Максимальная длительность /profile
+PROFILE_SAMPLE_INTERVAL = 0.005  # Интервал сэмплирования стека, секунд
+PROFILE_BLOCK_THRESHOLD = 0.1  # Блокировка event loop дольше этого попадает в отчет, секунд
+STATS_WINDOWS = {'15 мин': 15, '1 час': 60, 'день': None}  # Окна статистики в минутах (None - торговый день)
+
+# === ЛОГИРОВАНИЕ ===
+# Поля из extra, которые попадают в JSON-запись
+LOG_FIELDS = ('ticker', 'alert_type', 'stage', 'duration', 'user_id', 'broadcast_id', 'count', 'raw')
+
+
+class JsonFormatter(logging.Formatter):
+    """Форматирует запись лога в одну строку JSON"""
+
+    def format(self, record):
+        data = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for field in LOG_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        # Счетчики потерь лога: подавленные повторы и записи, не поместившиеся в очередь
+        for field in ('suppressed', 'suppressed_other', 'log_dropped'):
+            value = getattr(record, field, 0)
+            if value:
+                data[field] = value
+        if record.exc_info:
+            data['exc'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """Ограничивает повторяющиеся сообщения: после LOG_RATE_LIMIT_BURST за окно пропускает каждое N-е"""
+
+    def __init__(self, interval, burst, sample_every):
+        super().__init__()
+        self.interval = interval
+        self.burst = burst
+        self.sample_every = sample_every
+        self.windows = {}  # (уровень, шаблон сообщения) -> [начало окна, всего, подавлено]
+        self.evicted = 0  # Подавленные повторы из вытесненных окон, еще не попавшие в лог
+
+    def evict(self, now):
+        """Удаляет истекшие окна (или все, если их по-прежнему слишком много), сохраняя счетчики"""
+        expired = [key for key, window in self.windows.items() if now - window[0] > self.interval]
+        if len(self.windows) - len(expired) > 1000:
+            expired = list(self.windows)
+        for key in expired:
+            self.evicted += self.windows.pop(key)[2]
+
+    def filter(self, record):
+        key = (record.levelno, record.msg)
+        now = time.monotonic()
+        window = self.windows.get(key)
+        if window is None or now - window[0] > self.interval:
+            # Подавленное в прошлом окне не теряем - о нем сообщит следующая пропущенная запись
+            carried = window[2] if window else 0
+            if len(self.windows) > 1000:
+                self.evict(now)
+            window = self.windows[key] = [now, 0, carried]
+
+        window[1] += 1
+        if window[1] <= self.burst or window[1] % self.sample_every == 0:
+            record.suppressed = window[2]
+            window[2] = 0
+            if self.evicted:
+                record.suppressed_other = self.evicted
+                self.evicted = 0
+            return True
+        window[2] += 1
+        return False
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Кладет записи в очередь без ожидания; при переполнении запись отбрасывается"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0  # Отброшено с момента последней записи, попавшей в очередь
+        self.dropped_total = 0  # Для /health
+
+    def prepare(self, record):
+        # В отличие от QueueHandler.prepare не форматируем запись здесь: сообщение и трейсбек
+        # форматирует JsonFormatter в потоке QueueListener
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        # record - копия из prepare, число потерянных записей сообщаем в первой дошедшей
+        record.log_dropped = self.dropped
+        try:
+            self.queue.put_nowait(record)
+            self.dropped = 0
+        except queue.Full:
+            self.dropped += 1
+            self.dropped_total += 1
+
+
+def setup_logging():
+    """Настраивает логирование: запись в поток вывода идет в отдельном потоке через очередь"""
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter())
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(RateLimitFilter(LOG_RATE_LIMIT_INTERVAL, LOG_RATE_LIMIT_BURST, LOG_SAMPLE_EVERY))
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    return queue_handler
+
+
+log_handler = setup_logging()
+logger = logging.getLogger('moex_scanner')
+
 
 # Инициализация бота
-bot = Bot(token=TELEGRAM_BOT_TOKEN)
+session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+bot = Bot(token=TELEGRAM_BOT_TOKEN, session=session)
 storage = MemoryStorage()
 dp = Dispatcher(storage=storage)
 
 # Глобальные переменные
 known_alerts = set()  # Хранит ID всех обработанных алертов
-check_interval = 60  # Интервал проверки в секундах (по умолчанию 5 минут)
+known_alerts_date = None  # Торговый день, к которому относятся known_alerts
+last_alert_datetime = None  # Курсор ингестии: время самого свежего обработанного алерта
+entitlement_cache = {}  # user_id -> (окончание доступа, время проверки, версия доступа)
+startup_status = {}  # Этап запуска -> состояние для /health
+db_ready = asyncio.Event()  # Схема БД проверена, обработчики могут работать
+started_at = time.monotonic()
+background_tasks = set()  # Ссылки на фоновые задачи, чтобы их не удалил сборщик мусора
+check_interval = CHECK_INTERVAL  # Интервал проверки в секундах (по умолчанию 1 минута)
 
 
 # === БАЗА ДАННЫХ ===
 def init_db():
-    conn = sqlite3.connect('alerts_bot.db')
+    conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
 
+    # WAL: читатели не блокируют запись, когда базу делят несколько экземпляров бота
+    cursor.execute('PRAGMA journal_mode=WAL')
+
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS users (
         user_id INTEGER PRIMARY KEY,
@@ -72,12 +262,69 @@ def init_db():
     )
     ''')
 
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        broadcast_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        segment TEXT,
+        text TEXT NULL,
+        from_chat_id INTEGER NULL,
+        message_id INTEGER NULL,
+        status TEXT DEFAULT 'draft',
+        last_user_id INTEGER DEFAULT 0,
+        sent INTEGER DEFAULT 0,
+        failed INTEGER DEFAULT 0,
+        blocked INTEGER DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        finished_at TIMESTAMP NULL
+    )
+    ''')
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+        broadcast_id INTEGER,
+        user_id INTEGER,
+        status TEXT,
+        PRIMARY KEY (broadcast_id, user_id)
+    )
+    ''')
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS leader_lease (
+        name TEXT PRIMARY KEY,
+        holder TEXT,
+        expires_at REAL
+    )
+    ''')
+
+    # Алерты, отправку которых закрепил за собой лидер, - чтобы после смены лидера не задвоить
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS sent_alerts (
+        alert_key TEXT PRIMARY KEY,
+        holder TEXT,
+        claimed_at TIMESTAMP,
+        status TEXT DEFAULT 'sent'
+    )
+    ''')
+
+    # sent - отправлен (или отправляется), shed - сброшен в сводку при перегрузке
+    cursor.execute('PRAGMA table_info(sent_alerts)')
+    if 'status' not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE sent_alerts ADD COLUMN status TEXT DEFAULT 'sent'")
+
+    # Отметка о том, что пользователь заблокировал бота (в старых базах колонки нет)
+    cursor.execute('PRAGMA table_info(users)')
+    if 'bot_blocked' not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute('ALTER TABLE users ADD COLUMN bot_blocked BOOLEAN DEFAULT FALSE')
+
+    # Версия доступа: растет при каждой выдаче и отзыве, по ней экземпляры сверяют свой кэш
+    cursor.execute('PRAGMA table_info(users)')
+    if 'access_version' not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute('ALTER TABLE users ADD COLUMN access_version INTEGER DEFAULT 0')
+
     conn.commit()
     conn.close()
 
 
-init_db()
-
 
 def get_alert_description(alert_type):
     """Возвращает понятное описание типа алерта"""
@@ -147,6 +394,50 @@ def format_probability(m_15_data):
 
     return f"{formatted_percent} ↑{up} ↓{down}"
 
+
+def run_in_background(coro):
+    """Запускает корутину фоновой задачей и хранит ссылку на нее до завершения"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+class TelegramExecutor:
+    """Выполняет запросы к Telegram с ограничением параллельности и частоты"""
+
+    def __init__(self, concurrency, rate_limit):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.interval = 1 / rate_limit
+        self.next_slot = 0.0
+
+    async def wait_slot(self):
+        """Ждет следующего свободного слота с учетом лимита запросов в секунду"""
+        now = time.monotonic()
+        delay = self.next_slot - now
+        self.next_slot = max(now, self.next_slot) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def pause(self, seconds):
+        """Откладывает все следующие запросы, когда Telegram включил flood control"""
+        self.next_slot = max(self.next_slot, time.monotonic() + seconds)
+
+    async def call(self, method, *args, retries=3, **kwargs):
+        async with self.semaphore:
+            for attempt in range(retries + 1):
+                await self.wait_slot()
+                try:
+                    return await method(*args, **kwargs)
+                except TelegramRetryAfter as e:
+                    if attempt == retries:
+                        raise
+                    self.pause(e.retry_after)
+
+
+telegram_executor = TelegramExecutor(TELEGRAM_CONCURRENCY, TELEGRAM_RATE_LIMIT)
+
+
 async def unban_user(user_id: int):
     """Удаляет пользователя из черного списка канала"""
     try:
@@ -157,14 +448,14 @@ async def unban_user(user_id: int):
         )
         return True
     except Exception as e:
-        print(f"Ошибка при разбане пользователя {user_id}: {e}")
+        logger.warning("Ошибка при разбане пользователя %s: %s", user_id, e, extra={'user_id': user_id})
         return False
 
 
 def fetch_moex_alerts():
     """Запрашивает данные аномалий с MOEX API"""
     current_date = datetime.now().strftime('%Y-%m-%d')
-    api_url = f'https://apim.moex.com/iss/datashop/algopack/eq/alerts.json?date={current_date}'
+    api_url = f'{MOEX_API_URL}/iss/datashop/algopack/eq/alerts.json?date={current_date}'
 
     headers = {
         'Authorization': f'Bearer {MOEX_TOKEN}',
@@ -180,14 +471,14 @@ def fetch_moex_alerts():
             if 'data' in data and 'data' in data['data']:
                 return data['data']['data']
             else:
-                print("Неожиданная структура ответа API")
+                logger.error("Неожиданная структура ответа API", extra={'stage': 'fetch'})
                 return None
         else:
-            print(f"HTTP ошибка: {response.status_code}")
+            logger.error("HTTP ошибка: %s", response.status_code, extra={'stage': 'fetch'})
             return None
 
     except Exception as e:
-        print(f"Ошибка при запросе к API: {str(e)}")
+        logger.error("Ошибка при запросе к API: %s", e, extra={'stage': 'fetch'})
         return None
 
 
@@ -223,11 +514,137 @@ def parse_alert(alert):
 
         return alert_data
     except Exception as e:
-        print(f"Ошибка парсинга алерта: {str(e)}")
-        print("Сырые данные:", alert)
+        # Сырые данные обрезаем, повторы ограничивает RateLimitFilter
+        logger.warning("Ошибка парсинга алерта: %s", e, extra={'stage': 'parse', 'raw': repr(alert)[:300]})
         return None
 
 
+# === СПРАВОЧНИК ИНСТРУМЕНТОВ ===
+Instrument = namedtuple('Instrument', ['name', 'lot_size', 'price_step', 'price', 'sector'])
+
+instruments = {}  # тикер -> Instrument
+instruments_date = None  # Торговый день, за который загружен справочник
+instruments_loaded_at = 0.0  # time.time() последней загрузки с ISS
+
+
+def fetch_instruments():
+    """Загружает с ISS все бумаги режима торгов одним запросом"""
+    api_url = (
+        f'{MOEX_ISS_URL}/iss/engines/stock/markets/shares/boards/{INSTRUMENTS_BOARD}/securities.json'
+        '?iss.meta=off&iss.only=securities'
+        '&securities.columns=SECID,SHORTNAME,LOTSIZE,MINSTEP,PREVPRICE,SECTORID'
+    )
+    response = requests.get(api_url, timeout=30)
+    response.raise_for_status()
+    data = response.json()['securities']
+    columns = {name: i for i, name in enumerate(data['columns'])}
+
+    table = {}
+    for row in data['data']:
+        table[row[columns['SECID']]] = Instrument(
+            name=row[columns['SHORTNAME']],
+            lot_size=int(row[columns['LOTSIZE']] or 1),
+            price_step=row[columns['MINSTEP']],
+            price=row[columns['PREVPRICE']],
+            sector=row[columns['SECTORID']] or None,
+        )
+    return table
+
+
+def save_instruments(table, date, loaded_at):
+    tmp_path = f'{INSTRUMENTS_PATH}.{os.getpid()}.tmp'  # Файл общий для всех экземпляров
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({
+            'date': date,
+            'loaded_at': loaded_at,
+            'board': INSTRUMENTS_BOARD,
+            'columns': Instrument._fields,
+            'instruments': {ticker: list(instrument) for ticker, instrument in table.items()},
+        }, f, ensure_ascii=False)
+    os.replace(tmp_path, INSTRUMENTS_PATH)
+
+
+def load_instruments_from_disk():
+    """Холодный старт: справочник с диска, даже если он за прошлый день"""
+    global instruments, instruments_date, instruments_loaded_at
+
+    try:
+        with open(INSTRUMENTS_PATH, encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get('board') != INSTRUMENTS_BOARD or data.get('columns') != list(Instrument._fields):
+            logger.info("Справочник инструментов на диске в другом формате, загрузим с ISS", extra={'stage': 'instruments'})
+            return
+        table = {ticker: Instrument(*row) for ticker, row in data['instruments'].items()}
+        date, loaded_at = data['date'], float(data['loaded_at'])
+    except FileNotFoundError:
+        return
+    except Exception as e:
+        # Поврежденный файл не должен мешать загрузке с ISS
+        logger.warning("Справочник инструментов на диске не прочитан: %s", e, extra={'stage': 'instruments'})
+        return
+
+    instruments, instruments_date, instruments_loaded_at = table, date, loaded_at
+    logger.info("Справочник инструментов загружен с диска за %s: %s бумаг", instruments_date, len(instruments),
+                extra={'stage': 'instruments', 'count': len(instruments)})
+
+
+def instruments_stale():
+    today = datetime.now().strftime('%Y-%m-%d')
+    return instruments_date != today or time.time() - instruments_loaded_at > INSTRUMENTS_TTL_HOURS * 3600
+
+
+async def refresh_instruments():
+    """Перезагружает справочник с ISS; таблица подменяется целиком, без частичных состояний"""
+    global instruments, instruments_date, instruments_loaded_at
+
+    started = time.monotonic()
+    table = await asyncio.to_thread(fetch_instruments)
+    date, loaded_at = datetime.now().strftime('%Y-%m-%d'), time.time()
+    instruments, instruments_date, instruments_loaded_at = table, date, loaded_at
+    await asyncio.to_thread(save_instruments, table, date, loaded_at)
+    logger.info("Справочник инструментов обновлен: %s бумаг", len(table),
+                extra={'stage': 'instruments', 'count': len(table), 'duration': round(time.monotonic() - started, 3)})
+
+
+async def init_instruments():
+    await asyncio.to_thread(load_instruments_from_disk)
+    if instruments_stale():
+        await refresh_instruments()
+
+
+async def instruments_refresher():
+    """Раз в торговый день (или по истечении TTL) обновляет справочник"""
+    while True:
+        await asyncio.sleep(600)
+        if instruments_stale():
+            try:
+                await refresh_instruments()
+            except Exception as e:
+                logger.warning("Ошибка обновления справочника инструментов: %s", e, extra={'stage': 'instruments'})
+
+
+def format_rub(value):
+    if value >= 1e9:
+        return f"{value / 1e9:.2f} млрд ₽"
+    if value >= 1e6:
+        return f"{value / 1e6:.1f} млн ₽"
+    if value >= 1e3:
+        return f"{value / 1e3:.0f} тыс ₽"
+    return f"{value:.0f} ₽"
+
+
+def format_lots(lots, instrument):
+    """Объем в лотах и, если известна цена, примерный оборот в рублях"""
+    try:
+        lots = float(lots)
+    except (ValueError, TypeError):
+        return f"{lots} лот"
+    text = f"{int(lots)} лот"
+    if instrument and instrument.price:
+        text += f" (≈{format_rub(lots * instrument.lot_size * instrument.price)})"
+    return text
+
+
 async def send_alert_to_channel(alert):
     """Форматирует и отправляет алерт в канал"""
     alert_desc = get_alert_description(alert['alert_type'])
@@ -235,81 +652,333 @@ async def send_alert_to_channel(alert):
     value_str = format_value(alert['value'], alert['alert_type'])
     threshold_str = format_value(alert['threshold'], alert['alert_type'])
 
+    # Только поиск в памяти, без запросов к ISS на каждый алерт
+    instrument = instruments.get(alert['ticker'])
+    ticker_str = alert['ticker']
+    if instrument:
+        ticker_str += f" — {html.escape(instrument.name)}"
+    if value_str.endswith(' лот'):
+        value_str = format_lots(alert['value'], instrument)
+
     message = (
         f"🚨 <b>{alert_desc}</b>\n"
-        f"📊 <b>Тикер:</b> {alert['ticker']}\n"
+        f"📊 <b>Тикер:</b> {ticker_str}\n"
         f"⏰ <b>Время:</b> {alert['time']}\n"
         f"📈 <b>Значение:</b> {value_str} (порог: {threshold_str})\n"
         f"📊 <b>Статистика 15 мин:</b> {prob_str}\n"
-        f"🔍 <b>Продажи:</b> {alert['vol_s']} лот | <b>Покупки:</b> {alert['vol_b']} лот"
+        f"🔍 <b>Продажи:</b> {format_lots(alert['vol_s'], instrument)} | "
+        f"<b>Покупки:</b> {format_lots(alert['vol_b'], instrument)}"
     )
 
+    started = time.monotonic()
     try:
         await bot.send_message(
             chat_id=ALERTS_CHANNEL_ID,
             text=message,
             parse_mode='HTML'
         )
-        print(f"Отправлен алерт для {alert['ticker']}")
+        logger.info(
+            "Отправлен алерт для %s", alert['ticker'],
+            extra={
+                'stage': 'send',
+                'ticker': alert['ticker'],
+                'alert_type': alert['alert_type'],
+                'duration': round(time.monotonic() - started, 3)
+            }
+        )
+    except TelegramRetryAfter:
+        # Flood control обрабатывает очередь отправки
+        raise
     except Exception as e:
-        print(f"Ошибка при отправке сообщения: {str(e)}")
+        logger.error(
+            "Ошибка при отправке сообщения: %s", e,
+            extra={'stage': 'send', 'ticker': alert['ticker'], 'alert_type': alert['alert_type']}
+        )
 
 
 async def check_new_alerts():
-    """Проверяет новые алерты и отправляет только свежие (за последний час)"""
-    global known_alerts
+    """Проверяет новые алерты и отправляет только свежие (за последний час); False - MOEX не ответил"""
+    global known_alerts_date, last_alert_datetime, takeover_recheck
 
     current_time = datetime.now()
     one_hour_ago = current_time - timedelta(hours=1)
-    print(f"Проверка новых алертов за период с {one_hour_ago} по {current_time}")
-
-    alerts = fetch_moex_alerts()
+    logger.debug("Проверка новых алертов за период с %s по %s", one_hour_ago, current_time, extra={'stage': 'poll'})
+
+    started = time.monotonic()
+    # requests блокирует, поэтому запрос выполняется в отдельном потоке
+    alerts = await asyncio.to_thread(fetch_moex_alerts)
+    logger.debug(
+        "Получено алертов от API: %s", len(alerts) if alerts else 0,
+        extra={'stage': 'fetch', 'duration': round(time.monotonic() - started, 3)}
+    )
+    if alerts is None:
+        return False
     if not alerts:
-        return
+        return True
+
+    # ID алертов не содержат даты, поэтому с новым торговым днем начинаем заново
+    today = current_time.strftime('%Y-%m-%d')
+    if known_alerts_date != today:
+        known_alerts.clear()
+        known_alerts_date = today
+        last_alert_datetime = None
+        await asyncio.to_thread(prune_sent_alerts, today)
+
+    # Строки старше курсора (с запасом на запоздавшие) уже обработаны - не разбираем их повторно.
+    # После смены лидера перепроверяем весь последний час: очередь прежнего могла отстать сильнее
+    cursor = None
+    if last_alert_datetime and not takeover_recheck:
+        cursor = (last_alert_datetime - timedelta(seconds=ALERT_CURSOR_MARGIN)).strftime('%Y-%m-%d %H:%M:%S')
 
     new_alerts = []
+    unconfirmed = []  # Свежие алерты, которые прежний лидер мог не успеть отправить
     for alert_data in alerts:
+        try:
+            if cursor and f"{alert_data[0]} {alert_data[1]}" < cursor:
+                continue
+        except (IndexError, TypeError):
+            pass
+
         alert = parse_alert(alert_data)
         if not alert:
             continue
 
         alert_id = f"{alert['ticker']}_{alert['time']}_{alert['alert_type']}"
+        if alert_id in known_alerts:
+            if takeover_recheck and alert['datetime'] >= one_hour_ago:
+                unconfirmed.append(alert)
+            continue
 
-        # Проверяем что алерт свежий (не старше 1 часа) и еще не был обработан
-        if alert['datetime'] >= one_hour_ago and alert_id not in known_alerts:
-            known_alerts.add(alert_id)
+        # В статистику попадают все алерты дня, в канал - только свежие (не старше 1 часа)
+        known_alerts.add(alert_id)
+        alert_stats.add(alert)
+        if last_alert_datetime is None or alert['datetime'] > last_alert_datetime:
+            last_alert_datetime = alert['datetime']
+        if alert['datetime'] >= one_hour_ago:
             new_alerts.append(alert)
 
+    if takeover_recheck:
+        takeover_recheck = False
+        claimed = await asyncio.to_thread(load_claimed_alerts, today)
+        new_alerts.extend(alert for alert in unconfirmed if alert_key(alert) not in claimed)
+
     if new_alerts:
-        print(f"Найдено {len(new_alerts)} новых алертов за последний час")
-        # Сортируем по времени перед отправкой
-        for alert in sorted(new_alerts, key=lambda x: x['datetime']):
-            await send_alert_to_channel(alert)
+        logger.info(
+            "Найдено %s новых алертов за последний час", len(new_alerts),
+            extra={'stage': 'poll', 'count': len(new_alerts), 'duration': round(time.monotonic() - started, 3)}
+        )
+        # Порядок отправки определяет очередь: сначала важные, затем по времени
+        for alert in new_alerts:
+            alert_queue.put(alert)
+        await save_snapshot()
     else:
-        print("Новых алертов за последний час не найдено")
+        logger.debug("Новых алертов за последний час не найдено", extra={'stage': 'poll'})
+    return True
+
+
+# === ПРИОРИТЕТНАЯ ОТПРАВКА АЛЕРТОВ ===
+SEVERITY_LOW = 0
+SEVERITY_NORMAL = 1
+SEVERITY_HIGH = 2
+SEVERITY_CRITICAL = 3
+ALERT_SHED_SEVERITY = SEVERITY_HIGH  # Алерты ниже этой важности при перегрузке сбрасываются в сводку
+
+# Важность по коду типа алерта (коды - как в get_alert_description)
+ALERT_SEVERITY = {
+    'vol_s_99_9_pctl': SEVERITY_CRITICAL,
+    'vol_b_99_9_pctl': SEVERITY_CRITICAL,
+    'vol_99_9_pctl': SEVERITY_CRITICAL,
+    'net_vol_99_9_pctl-': SEVERITY_CRITICAL,
+    'net_vol_99_9_pctl+': SEVERITY_CRITICAL,
+    'pr_change_99_9_pctl-': SEVERITY_CRITICAL,
+    'pr_change_99_9_pctl+': SEVERITY_CRITICAL,
+    'vol_max': SEVERITY_HIGH,
+    'vol_s_max': SEVERITY_HIGH,
+    'vol_b_max': SEVERITY_HIGH,
+    'net_vol_max': SEVERITY_HIGH,
+    'net_vol_min': SEVERITY_HIGH,
+    'pr_change_min': SEVERITY_HIGH,
+    'pr_change_max': SEVERITY_HIGH,
+    'pr_low_min': SEVERITY_HIGH,
+    'pr_high_max': SEVERITY_HIGH,
+    'vol_s_99_pctl': SEVERITY_NORMAL,
+    'vol_b_99_pctl': SEVERITY_NORMAL,
+    'vol_s_95_pctl': SEVERITY_LOW,
+    'vol_b_95_pctl': SEVERITY_LOW,
+}
+
+
+def get_alert_severity(alert_type):
+    """Возвращает важность алерта, неизвестные типы считаются обычными"""
+    return ALERT_SEVERITY.get(alert_type, SEVERITY_NORMAL)
+
+
+class AlertDeliveryQueue:
+    """Очередь отправки: сначала важные алерты, при перегрузке малозначимые сбрасываются в сводку"""
+
+    def __init__(self, max_size, max_age):
+        self.max_size = max_size
+        self.max_age = max_age
+        self.heap = []
+        self.counter = itertools.count()
+        self.event = asyncio.Event()
+        self.dropped = {}  # ticker -> число сброшенных алертов
+        self.shed_alerts = []  # Сброшенные алерты, еще не записанные в sent_alerts
+
+    def put(self, alert, queued_at=None):
+        severity = get_alert_severity(alert['alert_type'])
+        queued_at = queued_at or time.monotonic()
+        heapq.heappush(self.heap, (-severity, alert['datetime'], next(self.counter), queued_at, alert))
+        self.event.set()
+
+    def shed(self):
+        """Сбрасывает устаревшие и лишние алерты ниже ALERT_SHED_SEVERITY"""
+        now = time.monotonic()
+        sheddable = [item for item in self.heap if -item[0] < ALERT_SHED_SEVERITY]
+        if not sheddable:
+            return
+
+        dropped = [item for item in sheddable if now - item[3] > self.max_age]
+        overflow = len(self.heap) - len(dropped) - self.max_size
+        if overflow > 0:
+            # Сначала самые малозначимые, среди равных - самые старые
+            rest = sorted(
+                (item for item in sheddable if now - item[3] <= self.max_age),
+                key=lambda item: (-item[0], item[1])
+            )
+            dropped += rest[:overflow]
+        if not dropped:
+            return
+
+        dropped_ids = {item[2] for item in dropped}
+        self.heap = [item for item in self.heap if item[2] not in dropped_ids]
+        heapq.heapify(self.heap)
+        for item in dropped:
+            ticker = item[4]['ticker']
+            self.dropped[ticker] = self.dropped.get(ticker, 0) + 1
+            self.shed_alerts.append(item[4])
+
+    def take_shed_alerts(self):
+        shed_alerts, self.shed_alerts = self.shed_alerts, []
+        return shed_alerts
+
+    def take_summary(self):
+        dropped, self.dropped = self.dropped, {}
+        return dropped
+
+    async def get(self):
+        """Возвращает следующий алерт или сводку сброшенных алертов (dict ticker -> count)"""
+        while True:
+            self.shed()
+            if self.heap and (-self.heap[0][0] >= ALERT_SHED_SEVERITY or not self.dropped):
+                item = heapq.heappop(self.heap)
+                return item[4], item[3]
+            if self.dropped:
+                return self.take_summary(), None
+            self.event.clear()
+            await self.event.wait()
+
+    def clear(self):
+        self.heap = []
+        self.dropped = {}
+        self.shed_alerts = []
+
+    def __len__(self):
+        return len(self.heap)
+
+
+alert_queue = AlertDeliveryQueue(ALERT_QUEUE_MAX_SIZE, ALERT_QUEUE_MAX_AGE)
+
+
+async def send_dropped_summary(dropped):
+    """Отправляет в канал сводку по алертам, сброшенным из-за перегрузки"""
+    total = sum(dropped.values())
+    top = sorted(dropped.items(), key=lambda item: -item[1])[:10]
+    tickers = ' | '.join(f"{ticker}: {count}" for ticker, count in top)
+    if len(dropped) > len(top):
+        tickers += f" | и еще {len(dropped) - len(top)}"
+    logger.warning("Сброшено малозначимых алертов: %s", total, extra={'stage': 'shed', 'count': total})
+
+    await bot.send_message(
+        chat_id=ALERTS_CHANNEL_ID,
+        text=(
+            f"⚠️ <b>Поток алертов</b>\n"
+            f"Пропущено {total} менее важных алертов:\n"
+            f"{tickers}"
+        ),
+        parse_mode='HTML'
+    )
+
+
+async def alert_sender():
+    """Отправляет алерты из очереди в канал в порядке важности"""
+    while True:
+        item, queued_at = await alert_queue.get()
+        # Сброшенные алерты тоже отмечаем, иначе новый лидер отправит их при перепроверке
+        shed_alerts = alert_queue.take_shed_alerts()
+        if shed_alerts:
+            try:
+                await asyncio.to_thread(record_shed_alerts, shed_alerts)
+            except Exception as e:
+                logger.warning("Ошибка при записи сброшенных алертов: %s", e, extra={'stage': 'send'})
+
+        try:
+            if queued_at is None:
+                await send_dropped_summary(item)
+            elif item.get('claimed') or await asyncio.to_thread(claim_alert, item):
+                # Повтор после retry_after не должен упереться в собственную запись в sent_alerts
+                item['claimed'] = True
+                await send_alert_to_channel(item)
+            else:
+                logger.info("Алерт %s уже отправлен", alert_key(item), extra={'stage': 'send'})
+        except TelegramRetryAfter as e:
+            # Возвращаем в очередь с исходным временем, пока ждем - малозначимое может устареть
+            if queued_at is None:
+                for ticker, count in item.items():
+                    alert_queue.dropped[ticker] = alert_queue.dropped.get(ticker, 0) + count
+            else:
+                alert_queue.put(item, queued_at)
+            await asyncio.sleep(e.retry_after)
+        except Exception as e:
+            logger.exception("Ошибка при отправке из очереди алертов: %s", e, extra={'stage': 'send'})
 
 
 async def scheduled_checker():
     """Периодическая проверка новых алертов"""
+    first_poll = True
     while True:
-        await check_new_alerts()
+        try:
+            polled = await check_new_alerts()
+            error = None if polled else 'MOEX не ответил'
+        except Exception as e:
+            logger.exception("Ошибка в scheduled_checker: %s", e, extra={'stage': 'poll'})
+            error = str(e)
+        # Готовность - только после успешного опроса, до него /health показывает ошибку
+        if first_poll:
+            if error:
+                set_startup_status('first_poll', f'ошибка: {error}')
+            else:
+                first_poll = False
+                set_startup_status('first_poll', 'ready')
         await asyncio.sleep(check_interval)
 
 
 def add_user(user_id, username, full_name):
-    conn = sqlite3.connect('alerts_bot.db')
+    conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
     cursor.execute('''
     INSERT OR IGNORE INTO users (user_id, username, full_name, trial_start_date) 
     VALUES (?, ?, ?, ?)
     ''', (user_id, username, full_name, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+    # Пользователь снова пишет боту - значит, больше не блокирует его
+    cursor.execute('UPDATE users SET bot_blocked = FALSE WHERE user_id = ?', (user_id,))
     conn.commit()
     conn.close()
 
 
 def check_trial_period(user_id):
     """Проверяет, активен ли триальный период у пользователя"""
-    conn = sqlite3.connect('alerts_bot.db')
+    conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
     cursor.execute('SELECT trial_start_date, banned FROM users WHERE user_id = ?', (user_id,))
     result = cursor.fetchone()
@@ -325,7 +994,7 @@ def check_trial_period(user_id):
 
 def check_user_subscription(user_id):
     """Проверяет подписку пользователя и возвращает дату окончания или None"""
-    conn = sqlite3.connect('alerts_bot.db')
+    conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
 
     # Проверяем, не забанен ли пользователь
@@ -369,10 +1038,10 @@ def check_user_subscription(user_id):
             conn.commit()
 
             # Уведомляем пользователя
-            asyncio.create_task(notify_subscription_expired(user_id, end_date))
+            run_in_background(notify_subscription_expired(user_id, end_date))
 
             # Баним в канале
-            asyncio.create_task(
+            run_in_background(
                 bot.ban_chat_member(
                     chat_id=ALERTS_CHANNEL_ID,
                     user_id=user_id
@@ -380,13 +1049,44 @@ def check_user_subscription(user_id):
             )
 
             # Помечаем как забаненного
-            cursor.execute('UPDATE users SET banned = TRUE WHERE user_id = ?', (user_id,))
+            cursor.execute('UPDATE users SET banned = TRUE, access_version = access_version + 1 WHERE user_id = ?', (user_id,))
             conn.commit()
 
     conn.close()
     return active_sub[0] if active_sub else None
 
 
+def get_access_version(user_id):
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    cursor.execute('SELECT access_version FROM users WHERE user_id = ?', (user_id,))
+    row = cursor.fetchone()
+    conn.close()
+    return row[0] if row else None
+
+
+def get_entitlement(user_id):
+    """check_user_subscription с кэшем положительных ответов на ENTITLEMENT_CACHE_TTL
+
+    Доступ может выдать или отозвать другой экземпляр, поэтому попадание в кэш
+    сверяется с версией доступа пользователя в общей базе (один запрос по ключу).
+    """
+    now = datetime.now()
+    version = get_access_version(user_id)
+    cached = entitlement_cache.get(user_id)
+    if cached and cached[0] > now and time.time() - cached[1] < ENTITLEMENT_CACHE_TTL and cached[2] == version:
+        return cached[0]
+
+    end = check_user_subscription(user_id)
+    if isinstance(end, str):
+        end = datetime.strptime(end, '%Y-%m-%d %H:%M:%S')
+    if end:
+        entitlement_cache[user_id] = (end, time.time(), version)
+    else:
+        entitlement_cache.pop(user_id, None)
+    return end
+
+
 async def notify_subscription_expired(user_id, end_date):
     """Уведомляет пользователя об истечении подписки"""
     try:
@@ -396,15 +1096,12 @@ async def notify_subscription_expired(user_id, end_date):
             "Для возобновления доступа оформите подписку снова."
         )
     except Exception as e:
-        print(f"Ошибка при отправке уведомления пользователю {user_id}: {e}")
-
-def add_subscription(user_id, days):
-    """Добавляет подписку на указанное количество дней"""
-    conn = sqlite3.connect('alerts_bot.db')
-    cursor = conn.cursor()
+        logger.warning("Ошибка при отправке уведомления пользователю %s: %s", user_id, e, extra={'user_id': user_id})
 
-    # Снимаем бан в базе данных
-    cursor.execute('UPDATE users SET banned = FALSE WHERE user_id = ?', (user_id,))
+def insert_subscription(cursor, user_id, days):
+    """Снимает бан и добавляет подписку в рамках текущей транзакции, возвращает дату окончания"""
+    entitlement_cache.pop(user_id, None)
+    cursor.execute('UPDATE users SET banned = FALSE, access_version = access_version + 1 WHERE user_id = ?', (user_id,))
 
     start_date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     end_date = (datetime.now() + timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
@@ -414,11 +1111,26 @@ def add_subscription(user_id, days):
     VALUES (?, ?, ?)
     ''', (user_id, start_date, end_date))
 
+    return end_date
+
+
+def delete_subscriptions(cursor, user_id):
+    """Удаляет подписки пользователя и помечает его забаненным в рамках текущей транзакции"""
+    entitlement_cache.pop(user_id, None)
+    cursor.execute('DELETE FROM subscriptions WHERE user_id = ?', (user_id,))
+    cursor.execute('UPDATE users SET banned = TRUE, access_version = access_version + 1 WHERE user_id = ?', (user_id,))
+
+
+def add_subscription(user_id, days):
+    """Добавляет подписку на указанное количество дней"""
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    end_date = insert_subscription(cursor, user_id, days)
     conn.commit()
     conn.close()
 
     # Пытаемся разбанить пользователя в канале
-    asyncio.create_task(unban_user(user_id))
+    run_in_background(unban_user(user_id))
 
     return end_date
 
@@ -430,7 +1142,7 @@ def generate_payment_code():
 
 def add_payment_request(user_id, comment):
     """Добавляет запрос на оплату"""
-    conn = sqlite3.connect('alerts_bot.db')
+    conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
     cursor.execute('''
     INSERT INTO payments (user_id, comment, status) 
@@ -450,7 +1162,7 @@ async def cmd_start(message: types.Message):
     full_name = message.from_user.full_name
 
     add_user(user_id, username, full_name)
-    subscription_end = check_user_subscription(user_id)  # Используем новую функцию
+    subscription_end = get_entitlement(user_id)
 
     keyboard = InlineKeyboardBuilder()
 
@@ -469,12 +1181,12 @@ async def cmd_start(message: types.Message):
             if check_trial_period(user_id):
                 msg = "🎉 Вам доступен триальный период на 24 часа!"
             else:
-                msg = f"✅ Ваша подписка активна до {subscription_end}"
+                msg = f"✅ Ваша подписка активна до {subscription_end:%Y-%m-%d %H:%M:%S}"
 
             await message.answer(msg, reply_markup=keyboard.as_markup())
 
         except Exception as e:
-            print(f"Error creating invite link: {e}")
+            logger.error("Error creating invite link: %s", e, extra={'user_id': user_id})
             await message.answer("⚠️ Не удалось создать ссылку на канал. Пожалуйста, сообщите администратору.")
     else:
         keyboard.add(InlineKeyboardButton(
@@ -497,7 +1209,7 @@ async def activate_trial(callback: types.CallbackQuery):
     user_id = callback.from_user.id
 
     # Check if trial was already used
-    conn = sqlite3.connect('alerts_bot.db')
+    conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
     cursor.execute('SELECT trial_start_date FROM users WHERE user_id = ?', (user_id,))
     result = cursor.fetchone()
@@ -517,7 +1229,7 @@ async def activate_trial(callback: types.CallbackQuery):
     # Activate trial
     try:
         cursor.execute('''
-        UPDATE users SET trial_start_date = ?, banned = FALSE 
+        UPDATE users SET trial_start_date = ?, banned = FALSE, access_version = access_version + 1
         WHERE user_id = ?
         ''', (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), user_id))
         conn.commit()
@@ -540,7 +1252,7 @@ async def activate_trial(callback: types.CallbackQuery):
         )
     except Exception as e:
         await callback.answer("Ошибка при активации триала. Пожалуйста, попробуйте позже.", show_alert=True)
-        print(f"Error activating trial: {e}")
+        logger.error("Error activating trial: %s", e, extra={'user_id': user_id})
     finally:
         conn.close()
 
@@ -613,7 +1325,7 @@ async def confirm_payment(callback: types.CallbackQuery):
     payment_id = int(callback.data.split('_')[2])
 
     # Получаем информацию о платеже
-    conn = sqlite3.connect('alerts_bot.db')
+    conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
     cursor.execute('SELECT user_id FROM payments WHERE payment_id = ?', (payment_id,))
     user_id = cursor.fetchone()[0]
@@ -653,7 +1365,7 @@ async def reject_payment(callback: types.CallbackQuery):
     payment_id = int(callback.data.split('_')[2])
 
     # Обновляем статус платежа
-    conn = sqlite3.connect('alerts_bot.db')
+    conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
     cursor.execute('UPDATE payments SET status = "rejected" WHERE payment_id = ?', (payment_id,))
     conn.commit()
@@ -675,7 +1387,7 @@ async def subscription_checker():
     while True:
         try:
             # Получаем всех пользователей с подписками
-            conn = sqlite3.connect('alerts_bot.db')
+            conn = sqlite3.connect(DB_PATH)
             cursor = conn.cursor()
             cursor.execute('SELECT DISTINCT user_id FROM subscriptions WHERE status = "active"')
             users = cursor.fetchall()
@@ -688,54 +1400,358 @@ async def subscription_checker():
             await asyncio.sleep(60)  # Проверка каждую минуту
 
         except Exception as e:
-            print(f"Ошибка в subscription_checker: {e}")
+            logger.exception("Ошибка в subscription_checker: %s", e, extra={'stage': 'subscriptions'})
             await asyncio.sleep(60)
 
 async def check_expired_subscriptions():
     """Check and remove users with expired subscriptions"""
-    conn = sqlite3.connect('alerts_bot.db')
+    conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
 
     # Find users with expired subscriptions or trials
+    # (истекший триал не в счет, если у пользователя есть действующая подписка)
     cursor.execute('''
-    SELECT u.user_id, s.subscription_id
+    SELECT u.user_id
     FROM users u
-    LEFT JOIN subscriptions s ON u.user_id = s.user_id AND s.status = 'active'
-    WHERE 
-        (u.trial_start_date IS NOT NULL AND 
+    WHERE u.banned = FALSE
+    AND NOT EXISTS (
+        SELECT 1 FROM subscriptions s
+        WHERE s.user_id = u.user_id AND s.status = 'active'
+          AND datetime(s.end_date) > datetime('now')
+    )
+    AND (
+        (u.trial_start_date IS NOT NULL AND
          datetime(u.trial_start_date, '+24 hours') <= datetime('now')) OR
-        (s.end_date IS NOT NULL AND 
-         datetime(s.end_date) <= datetime('now'))
-    AND u.banned = FALSE
+        EXISTS (
+            SELECT 1 FROM subscriptions s
+            WHERE s.user_id = u.user_id AND s.status = 'active'
+              AND datetime(s.end_date) <= datetime('now')
+        )
+    )
     ''')
 
     expired_users = cursor.fetchall()
+    conn.close()
 
-    for user_id, subscription_id in expired_users:
-        try:
-            # Ban from channel
-            await bot.ban_chat_member(
-                chat_id=ALERTS_CHANNEL_ID,
-                user_id=user_id
-            )
-
-            # Mark as banned in DB and update subscription status
-            cursor.execute('UPDATE users SET banned = TRUE WHERE user_id = ?', (user_id,))
-            if subscription_id:
-                cursor.execute('UPDATE subscriptions SET status = "expired" WHERE subscription_id = ?', (subscription_id,))
+    async def expire(user_id):
+        # Ban from channel
+        await telegram_executor.call(
+            bot.ban_chat_member,
+            chat_id=ALERTS_CHANNEL_ID,
+            user_id=user_id
+        )
+        expired.append(user_id)
 
-            # Notify user
-            await bot.send_message(
+        # Notify user
+        try:
+            await telegram_executor.call(
+                bot.send_message,
                 user_id,
                 "❌ Ваша подписка истекла. Доступ к каналу закрыт.\n"
                 "Для возобновления доступа оформите подписку снова."
             )
         except Exception as e:
-            print(f"Ошибка при удалении пользователя {user_id}: {e}")
+            logger.warning("Ошибка при отправке уведомления пользователю %s: %s", user_id, e, extra={'user_id': user_id})
 
-    conn.commit()
+    # Баны и уведомления - параллельно с общим лимитом запросов к Telegram
+    expired = []
+    results = await asyncio.gather(*(expire(user_id) for (user_id,) in expired_users), return_exceptions=True)
+    for (user_id,), result in zip(expired_users, results):
+        if isinstance(result, Exception):
+            logger.warning("Ошибка при удалении пользователя %s: %s", user_id, result, extra={'user_id': user_id})
+
+    # Mark as banned in DB and update subscription status
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    for chunk in chunked(expired, BULK_DB_CHUNK_SIZE):
+        for user_id in chunk:
+            entitlement_cache.pop(user_id, None)
+            cursor.execute('UPDATE users SET banned = TRUE, access_version = access_version + 1 WHERE user_id = ?', (user_id,))
+            # Истекшими помечаем только подписки, срок которых действительно прошел
+            cursor.execute('''
+            UPDATE subscriptions SET status = "expired"
+            WHERE user_id = ? AND status = "active" AND datetime(end_date) <= datetime('now')
+            ''', (user_id,))
+        conn.commit()
     conn.close()
 
+    logger.info("Закрыт доступ пользователям с истекшей подпиской: %s", len(expired),
+                extra={'stage': 'subscriptions', 'count': len(expired)})
+
+
+# === СТАТИСТИКА АЛЕРТОВ ===
+def to_float(value):
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return 0.0
+
+
+class TickerStats:
+    """Скользящие агрегаты алертов одного тикера с ограниченным объемом памяти"""
+
+    def __init__(self):
+        self.date = None
+        self.day = self.new_bucket(None)
+        # Кольцевой буфер поминутных корзин за последний час
+        self.minutes = [self.new_bucket(-1) for _ in range(60)]
+        # Последние изменения цены за 15 минут: (минута, изменение %, ↑, ↓)
+        self.changes = deque(maxlen=STATS_CHANGES_HISTORY)
+        # Распределение изменений за весь день: изменение % -> число алертов (значения с точностью 0.01%)
+        self.day_changes = self.new_distribution()
+
+    @staticmethod
+    def new_distribution():
+        return {'values': {}, 'up': 0, 'down': 0}
+
+    @staticmethod
+    def add_to_distribution(distribution, change, up, down):
+        distribution['values'][change] = distribution['values'].get(change, 0) + 1
+        distribution['up'] += up
+        distribution['down'] += down
+
+    @staticmethod
+    def new_bucket(minute):
+        return {'minute': minute, 'count': 0, 'vol_b': 0.0, 'vol_s': 0.0, 'types': {}}
+
+    @staticmethod
+    def add_to_bucket(bucket, alert):
+        bucket['count'] += 1
+        bucket['vol_b'] += to_float(alert['vol_b'])
+        bucket['vol_s'] += to_float(alert['vol_s'])
+        bucket['types'][alert['alert_type']] = bucket['types'].get(alert['alert_type'], 0) + 1
+
+    def add(self, alert):
+        if alert['date'] != self.date:
+            self.date = alert['date']
+            self.day = self.new_bucket(None)
+            self.day_changes = self.new_distribution()
+        self.add_to_bucket(self.day, alert)
+
+        minute = int(alert['datetime'].timestamp() // 60)
+        bucket = self.minutes[minute % 60]
+        if bucket['minute'] < minute:
+            bucket = self.minutes[minute % 60] = self.new_bucket(minute)
+        if bucket['minute'] == minute:
+            self.add_to_bucket(bucket, alert)
+
+        change = (
+            minute,
+            round(to_float(alert['change_percent']), 2),
+            int(to_float(alert['up_count'])),
+            int(to_float(alert['down_count']))
+        )
+        self.changes.append(change)
+        self.add_to_distribution(self.day_changes, *change[1:])
+
+    def window(self, minutes, now=None):
+        """Агрегаты за последние minutes минут (None - за торговый день) и распределение изменений
+
+        Для окон в минутах распределение строится по последним STATS_CHANGES_HISTORY изменениям;
+        третий элемент результата - True, если окно этим ограничением обрезано.
+        """
+        if minutes is None:
+            if self.date != (now or datetime.now()).strftime('%Y-%m-%d'):
+                return self.new_bucket(None), self.new_distribution(), False
+            return self.day, self.day_changes, False
+
+        current = int((now or datetime.now()).timestamp() // 60)
+        result = self.new_bucket(None)
+        for bucket in self.minutes:
+            if current - minutes < bucket['minute'] <= current:
+                result['count'] += bucket['count']
+                result['vol_b'] += bucket['vol_b']
+                result['vol_s'] += bucket['vol_s']
+                for alert_type, count in bucket['types'].items():
+                    result['types'][alert_type] = result['types'].get(alert_type, 0) + count
+        distribution = self.new_distribution()
+        for change in self.changes:
+            if current - minutes < change[0] <= current:
+                self.add_to_distribution(distribution, *change[1:])
+        truncated = len(self.changes) == self.changes.maxlen and self.changes[0][0] > current - minutes
+        return result, distribution, truncated
+
+
+class AlertStats:
+    """Агрегаты по всем тикерам, обновляются по мере поступления алертов"""
+
+    def __init__(self):
+        self.tickers = {}
+        # /top пересчитывается не чаще раза на новый алерт или новую минуту, остальные вызовы - из кэша
+        self.version = 0
+        self.top_cache = {}  # (окно, limit) -> (версия, минута, строки)
+
+    def add(self, alert):
+        stats = self.tickers.get(alert['ticker'])
+        if stats is None:
+            stats = self.tickers[alert['ticker']] = TickerStats()
+        stats.add(alert)
+        self.version += 1
+
+    def clear(self):
+        self.tickers.clear()
+        self.version += 1
+
+    def get(self, ticker):
+        return self.tickers.get(ticker)
+
+    def to_dict(self):
+        return {
+            ticker: {
+                'date': stats.date,
+                'day': stats.day,
+                'minutes': [bucket for bucket in stats.minutes if bucket['minute'] >= 0],
+                'changes': list(stats.changes),
+                'day_changes': {
+                    'values': list(stats.day_changes['values'].items()),
+                    'up': stats.day_changes['up'],
+                    'down': stats.day_changes['down'],
+                },
+            }
+            for ticker, stats in self.tickers.items()
+        }
+
+    def load_dict(self, data):
+        for ticker, state in data.items():
+            stats = self.tickers[ticker] = TickerStats()
+            stats.date = state['date']
+            stats.day = state['day']
+            for bucket in state['minutes']:
+                stats.minutes[bucket['minute'] % 60] = bucket
+            stats.changes.extend(tuple(change) for change in state['changes'])
+            if 'day_changes' in state:
+                stats.day_changes = {
+                    'values': {change: count for change, count in state['day_changes']['values']},
+                    'up': state['day_changes']['up'],
+                    'down': state['day_changes']['down'],
+                }
+            else:
+                # Снимок старого формата: распределение дня только по сохраненным изменениям
+                for change in stats.changes:
+                    stats.add_to_distribution(stats.day_changes, *change[1:])
+        self.version += 1
+
+    def top(self, minutes, limit=10):
+        """Тикеры с наибольшим числом алертов за окно
+
+        Пересчет проходит по всем тикерам (O(тикеров)), но выполняется только после новых
+        алертов или смены минуты; повторные запросы между опросами MOEX отвечают из кэша за O(1).
+        """
+        now = datetime.now()
+        current = int(now.timestamp() // 60)
+        cached = self.top_cache.get((minutes, limit))
+        if cached and cached[0] == self.version and cached[1] == current:
+            return cached[2]
+
+        rows = []
+        for ticker, stats in self.tickers.items():
+            bucket, _, _ = stats.window(minutes, now)
+            if bucket['count']:
+                rows.append((bucket['count'], bucket['vol_b'] + bucket['vol_s'], ticker, bucket))
+        rows = heapq.nlargest(limit, rows, key=lambda row: (row[0], row[1]))
+        self.top_cache[(minutes, limit)] = (self.version, current, rows)
+        return rows
+
+
+alert_stats = AlertStats()
+
+
+def distribution_median(values):
+    """Медиана по словарю значение -> количество"""
+    total = sum(values.values())
+    middle = [(total - 1) // 2, total // 2]  # Индексы средних элементов
+    found = []
+    seen = 0
+    for value in sorted(values):
+        seen += values[value]
+        while middle and middle[0] < seen:
+            found.append(value)
+            middle.pop(0)
+    return (found[0] + found[1]) / 2
+
+
+def format_changes(distribution, truncated=False):
+    """Форматирует распределение изменений цены из окна"""
+    values = distribution['values']
+    if not values:
+        return "нет данных"
+    text = (
+        f"мин {min(values):.2f}% | медиана {distribution_median(values):.2f}% | "
+        f"макс {max(values):.2f}% | ↑{distribution['up']} ↓{distribution['down']}"
+    )
+    if truncated:
+        text += f" (последние {STATS_CHANGES_HISTORY})"
+    return text
+
+
+def can_view_stats(user_id):
+    return user_id == ADMIN_ID or get_entitlement(user_id)
+
+
+@dp.message(Command("stats"))
+async def cmd_stats(message: types.Message):
+    if not can_view_stats(message.from_user.id):
+        await message.answer("❌ Статистика доступна только подписчикам. Используйте /start")
+        return
+
+    args = message.text.split()
+    if len(args) != 2:
+        await message.answer("Используйте формат: /stats TICKER")
+        return
+
+    ticker = args[1].upper()
+    stats = alert_stats.get(ticker)
+    if stats is None:
+        await message.answer(f"По тикеру {ticker} сегодня алертов не было")
+        return
+
+    now = datetime.now()
+    text = f"📊 <b>{ticker}</b> — статистика алертов\n"
+    for title, minutes in STATS_WINDOWS.items():
+        bucket, changes, truncated = stats.window(minutes, now)
+        text += (
+            f"\n⏱ <b>{title}:</b> {bucket['count']} алертов\n"
+            f"🔍 Продажи: {int(bucket['vol_s'])} лот | Покупки: {int(bucket['vol_b'])} лот\n"
+            f"📈 Изменение 15 мин: {format_changes(changes, truncated)}\n"
+        )
+
+    day, _, _ = stats.window(None, now)
+    if day['types']:
+        text += "\n<b>Типы за день:</b>\n"
+        for alert_type, count in sorted(day['types'].items(), key=lambda item: -item[1]):
+            text += f"• {get_alert_description(alert_type)}: {count}\n"
+
+    await message.answer(text, parse_mode='HTML')
+
+
+@dp.message(Command("top"))
+async def cmd_top(message: types.Message):
+    if not can_view_stats(message.from_user.id):
+        await message.answer("❌ Статистика доступна только подписчикам. Используйте /start")
+        return
+
+    # Формат команды: /top [15|60|day]
+    args = message.text.split()
+    windows = {'15': '15 мин', '60': '1 час', 'day': 'день'}
+    window = args[1] if len(args) > 1 else '60'
+    if window not in windows:
+        await message.answer("Используйте формат: /top [15|60|day]")
+        return
+
+    rows = alert_stats.top(STATS_WINDOWS[windows[window]])
+    if not rows:
+        await message.answer(f"За период «{windows[window]}» алертов не было")
+        return
+
+    text = f"🔥 <b>Самые аномальные тикеры ({windows[window]}):</b>\n\n"
+    for place, (count, _, ticker, bucket) in enumerate(rows, 1):
+        text += (
+            f"{place}. <b>{ticker}</b> — {count} алертов | "
+            f"Покупки: {int(bucket['vol_b'])} лот | Продажи: {int(bucket['vol_s'])} лот\n"
+        )
+
+    await message.answer(text, parse_mode='HTML')
+
 
 # === АДМИН КОМАНДЫ ===
 @dp.message(Command("admin"))
@@ -745,7 +1761,7 @@ async def admin_panel(message: types.Message):
         return
 
     # Получаем список всех пользователей
-    conn = sqlite3.connect('alerts_bot.db')
+    conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
 
     cursor.execute('''
@@ -834,10 +1850,9 @@ async def revoke_subscription(message: types.Message):
         user_id = int(args[1])
 
         # Удаляем подписки пользователя
-        conn = sqlite3.connect('alerts_bot.db')
+        conn = sqlite3.connect(DB_PATH)
         cursor = conn.cursor()
-        cursor.execute('DELETE FROM subscriptions WHERE user_id = ?', (user_id,))
-        cursor.execute('UPDATE users SET banned = TRUE WHERE user_id = ?', (user_id,))
+        delete_subscriptions(cursor, user_id)
         conn.commit()
         conn.close()
 
@@ -848,7 +1863,7 @@ async def revoke_subscription(message: types.Message):
                 user_id=user_id
             )
         except Exception as e:
-            print(f"Ошибка при бане пользователя {user_id}: {e}")
+            logger.warning("Ошибка при бане пользователя %s: %s", user_id, e, extra={'user_id': user_id})
 
         # Уведомляем пользователя
         await bot.send_message(
@@ -862,20 +1877,1256 @@ async def revoke_subscription(message: types.Message):
         await message.answer(f"Ошибка: {str(e)}\n\nИспользуйте формат: /revoke_sub user_id")
 
 
-# === ЗАПУСК БОТА ===
-async def on_startup():
-    # Start background tasks
-    asyncio.create_task(scheduled_checker())  # For alerts
-    asyncio.create_task(subscription_checker())  # For subscriptions
+# === МАССОВЫЕ ОПЕРАЦИИ С ПОДПИСКАМИ ===
+def parse_bulk_entries(text, default_days=None, with_days=True):
+    """Разбирает строки вида 'user_id [days]', возвращает список (user_id, days) и ошибочные строки
+
+    При with_days=False строка со вторым столбцом считается ошибочной (для отзыва срок не нужен).
+    """
+    entries = []
+    errors = []
+    seen = set()
+    for line in text.splitlines():
+        parts = line.replace(',', ' ').replace(';', ' ').replace(':', ' ').split()
+        if not parts:
+            continue
+        try:
+            user_id = int(parts[0])
+            days = int(parts[1]) if len(parts) > 1 else default_days
+            if len(parts) > (2 if with_days else 1) or (default_days is not None and (days is None or days <= 0)):
+                raise ValueError
+        except ValueError:
+            errors.append(line.strip())
+            continue
+        if user_id in seen:
+            continue
+        seen.add(user_id)
+        entries.append((user_id, days))
+    return entries, errors
+
+
+async def read_bulk_input(message: types.Message):
+    """Возвращает аргументы команды и список пользователей из текста или приложенного файла"""
+    text = message.text or message.caption or ''
+    command_line, _, body = text.partition('\n')
+    args = command_line.split()[1:]
+
+    if message.document:
+        file = await bot.download(message.document)
+        body = file.read().decode('utf-8-sig', errors='replace')
+
+    return args, body
+
+
+def chunked(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class BulkProgress:
+    """Показывает администратору ход массовой операции в одном сообщении"""
+
+    def __init__(self, status_message, title, total, min_interval=3):
+        self.status_message = status_message
+        self.title = title
+        self.total = total
+        self.min_interval = min_interval
+        self.stage = ''
+        self.done = 0
+        self.last_update = 0.0
+
+    async def update(self, stage=None, done=None, force=False):
+        if stage is not None:
+            self.stage = stage
+        if done is not None:
+            self.done = done
+        now = time.monotonic()
+        if not force and now - self.last_update < self.min_interval:
+            return
+        self.last_update = now
+        try:
+            await self.status_message.edit_text(
+                f"⏳ {self.title}\n{self.stage}: {self.done}/{self.total}"
+            )
+        except Exception as e:
+            logger.warning("Ошибка при обновлении прогресса: %s", e, extra={'stage': 'bulk'})
 
-    # Initial check of subscriptions
-    await check_expired_subscriptions()
-    print("Бот запущен")
 
+async def run_bulk_telegram(entries, worker, progress):
+    """Выполняет worker для каждого пользователя через telegram_executor и собирает результаты"""
+    results = {}
+    done = 0
 
-async def main():
-    await on_startup()
-    await dp.start_polling(bot)
+    async def run_one(entry):
+        nonlocal done
+        user_id = entry[0]
+        try:
+            results[user_id] = await worker(*entry)
+        except Exception as e:
+            results[user_id] = f"ошибка: {e}"
+        done += 1
+        await progress.update(done=done)
+
+    await asyncio.gather(*(run_one(entry) for entry in entries))
+    return results
+
+
+async def send_bulk_summary(message: types.Message, title, results, errors):
+    """Отправляет итог массовой операции; подробности по пользователям - файлом"""
+    ok_count = sum(1 for result in results.values() if result.startswith('ok'))
+    summary = (
+        f"✅ {title} завершено\n"
+        f"Успешно: {ok_count}\n"
+        f"С ошибками: {len(results) - ok_count}\n"
+        f"Нераспознанных строк: {len(errors)}"
+    )
+
+    lines = ["user_id;result"]
+    lines += [f"{user_id};{result}" for user_id, result in results.items()]
+    lines += [f"{line};нераспознанная строка" for line in errors]
+    report = BufferedInputFile('\n'.join(lines).encode('utf-8'), filename='bulk_result.csv')
+
+    await message.answer_document(report, caption=summary)
+
+
+@dp.message(Command("grant_sub_bulk"))
+async def grant_subscription_bulk(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("Доступ запрещен")
+        return
+
+    usage = (
+        "Используйте формат:\n/grant_sub_bulk days\nuser_id [days]\nuser_id [days]\n...\n\n"
+        "Список можно приложить файлом с командой в подписи."
+    )
+
+    try:
+        args, body = await read_bulk_input(message)
+        if len(args) != 1:
+            raise ValueError("Неверный формат команды")
+        entries, errors = parse_bulk_entries(body, default_days=int(args[0]))
+        if not entries:
+            raise ValueError("Список пользователей пуст")
+    except Exception as e:
+        await message.answer(f"Ошибка: {str(e)}\n\n{usage}")
+        return
+
+    status_message = await message.answer(f"⏳ Выдача подписок: {len(entries)} пользователей")
+    progress = BulkProgress(status_message, "Выдача подписок", len(entries))
+
+    # Все изменения в БД - пачками, по одной транзакции на пачку
+    end_dates = {}
+    results = {}
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    done = 0
+    for chunk in chunked(entries, BULK_DB_CHUNK_SIZE):
+        try:
+            for user_id, days in chunk:
+                end_dates[user_id] = insert_subscription(cursor, user_id, days)
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            for user_id, _ in chunk:
+                end_dates.pop(user_id, None)
+                results[user_id] = f"ошибка БД: {e}"
+        done += len(chunk)
+        await progress.update("Запись в базу", done)
+    conn.close()
+
+    async def grant_in_channel(user_id, days):
+        # Подписка уже записана в базу: ошибки Telegram не должны выглядеть как невыданная подписка
+        end_date = end_dates[user_id]
+        try:
+            await telegram_executor.call(
+                bot.unban_chat_member,
+                chat_id=ALERTS_CHANNEL_ID,
+                user_id=user_id,
+                only_if_banned=True
+            )
+        except Exception as e:
+            return f"ok до {end_date}, разбан не удался: {e}"
+        try:
+            invite_link = await telegram_executor.call(
+                bot.create_chat_invite_link,
+                chat_id=ALERTS_CHANNEL_ID,
+                member_limit=1
+            )
+        except Exception as e:
+            return f"ok до {end_date}, ссылка не создана: {e}"
+
+        keyboard = InlineKeyboardBuilder()
+        keyboard.add(InlineKeyboardButton(
+            text="Перейти в канал",
+            url=invite_link.invite_link
+        ))
+
+        try:
+            await telegram_executor.call(
+                bot.send_message,
+                user_id,
+                f"🎉 Администратор активировал вам подписку на {days} дней (до {end_date})!\n\n",
+                reply_markup=keyboard.as_markup()
+            )
+        except Exception as e:
+            return f"ok до {end_date}, уведомление не доставлено: {e}"
+        return f"ok до {end_date}"
+
+    await progress.update("Telegram", 0, force=True)
+    granted = [(user_id, days) for user_id, days in entries if user_id in end_dates]
+    results.update(await run_bulk_telegram(granted, grant_in_channel, progress))
+
+    await progress.update("Готово", len(entries), force=True)
+    await send_bulk_summary(message, "Выдача подписок", results, errors)
+
+
+@dp.message(Command("revoke_sub_bulk"))
+async def revoke_subscription_bulk(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("Доступ запрещен")
+        return
+
+    usage = (
+        "Используйте формат:\n/revoke_sub_bulk\nuser_id\nuser_id\n...\n\n"
+        "Список можно приложить файлом с командой в подписи."
+    )
+
+    try:
+        args, body = await read_bulk_input(message)
+        # ID можно перечислить и прямо в строке команды
+        entries, errors = parse_bulk_entries('\n'.join(args) + '\n' + body, with_days=False)
+        if not entries:
+            raise ValueError("Список пользователей пуст")
+    except Exception as e:
+        await message.answer(f"Ошибка: {str(e)}\n\n{usage}")
+        return
+
+    status_message = await message.answer(f"⏳ Отмена подписок: {len(entries)} пользователей")
+    progress = BulkProgress(status_message, "Отмена подписок", len(entries))
+
+    results = {}
+    revoked = []
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    done = 0
+    for chunk in chunked(entries, BULK_DB_CHUNK_SIZE):
+        try:
+            for user_id, _ in chunk:
+                delete_subscriptions(cursor, user_id)
+            conn.commit()
+            revoked.extend(chunk)
+        except Exception as e:
+            conn.rollback()
+            for user_id, _ in chunk:
+                results[user_id] = f"ошибка БД: {e}"
+        done += len(chunk)
+        await progress.update("Запись в базу", done)
+    conn.close()
+
+    async def revoke_in_channel(user_id, _):
+        try:
+            await telegram_executor.call(
+                bot.ban_chat_member,
+                chat_id=ALERTS_CHANNEL_ID,
+                user_id=user_id
+            )
+        except Exception as e:
+            return f"ошибка бана: {e}"
+
+        try:
+            await telegram_executor.call(
+                bot.send_message,
+                user_id,
+                "❌ Ваша подписка была отменена администратором. Доступ к каналу закрыт."
+            )
+        except Exception as e:
+            return f"ok, уведомление не доставлено: {e}"
+        return "ok"
+
+    await progress.update("Telegram", 0, force=True)
+    results.update(await run_bulk_telegram(revoked, revoke_in_channel, progress))
+
+    await progress.update("Готово", len(entries), force=True)
+    await send_bulk_summary(message, "Отмена подписок", results, errors)
+
+
+# === РАССЫЛКИ ===
+# Условия отбора получателей по сегментам (u - таблица users)
+BROADCAST_SEGMENTS = {
+    'all': '1 = 1',
+    'active': """EXISTS (
+        SELECT 1 FROM subscriptions s
+        WHERE s.user_id = u.user_id AND s.status = 'active' AND datetime(s.end_date) > datetime(:now)
+    )""",
+    'trial': """u.trial_start_date IS NOT NULL
+        AND datetime(u.trial_start_date, :trial_offset) > datetime(:now)""",
+    'expired': """(u.trial_start_date IS NOT NULL OR EXISTS (SELECT 1 FROM subscriptions s WHERE s.user_id = u.user_id))
+        AND NOT EXISTS (
+            SELECT 1 FROM subscriptions s
+            WHERE s.user_id = u.user_id AND s.status = 'active' AND datetime(s.end_date) > datetime(:now)
+        )
+        AND NOT (u.trial_start_date IS NOT NULL AND datetime(u.trial_start_date, :trial_offset) > datetime(:now))""",
+}
+
+active_broadcasts = {}  # broadcast_id -> задача, выполняющая рассылку
+
+
+def segment_params():
+    return {
+        'now': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'trial_offset': f'+{TRIAL_PERIOD_HOURS} hours',
+    }
+
+
+def count_segment(segment):
+    """Считает получателей сегмента"""
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    cursor.execute(
+        f'SELECT COUNT(*) FROM users u WHERE u.bot_blocked = FALSE AND ({BROADCAST_SEGMENTS[segment]})',
+        segment_params()
+    )
+    count = cursor.fetchone()[0]
+    conn.close()
+    return count
+
+
+def fetch_broadcast_batch(cursor, broadcast_id, segment, last_user_id):
+    """Возвращает следующую страницу получателей (keyset по user_id), пропуская уже обработанных"""
+    params = segment_params()
+    params.update({'broadcast_id': broadcast_id, 'last_user_id': last_user_id, 'limit': BROADCAST_BATCH_SIZE})
+    cursor.execute(f'''
+    SELECT u.user_id FROM users u
+    WHERE u.user_id > :last_user_id
+      AND u.bot_blocked = FALSE
+      AND ({BROADCAST_SEGMENTS[segment]})
+      AND NOT EXISTS (
+          SELECT 1 FROM broadcast_deliveries d
+          WHERE d.broadcast_id = :broadcast_id AND d.user_id = u.user_id
+      )
+    ORDER BY u.user_id
+    LIMIT :limit
+    ''', params)
+    return [row[0] for row in cursor.fetchall()]
+
+
+async def run_broadcast(broadcast_id):
+    """Отправляет рассылку, сохраняя прогресс после каждого сообщения"""
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+
+    async def deliver(user_id):
+        try:
+            if message_id:
+                await telegram_executor.call(
+                    bot.copy_message,
+                    chat_id=user_id,
+                    from_chat_id=from_chat_id,
+                    message_id=message_id
+                )
+            else:
+                await telegram_executor.call(bot.send_message, user_id, text)
+            status = 'sent'
+        except TelegramForbiddenError:
+            # Пользователь заблокировал бота - больше ему не пишем
+            status = 'blocked'
+            cursor.execute('UPDATE users SET bot_blocked = TRUE WHERE user_id = ?', (user_id,))
+        except Exception as e:
+            logger.warning(
+                "Ошибка рассылки #%s пользователю %s: %s", broadcast_id, user_id, e,
+                extra={'broadcast_id': broadcast_id, 'user_id': user_id, 'stage': 'broadcast'}
+            )
+            status = 'failed'
+
+        # Фиксируем доставку сразу, чтобы после перезапуска не отправить повторно
+        cursor.execute('''
+        INSERT OR IGNORE INTO broadcast_deliveries (broadcast_id, user_id, status) VALUES (?, ?, ?)
+        ''', (broadcast_id, user_id, status))
+        cursor.execute(f'UPDATE broadcasts SET {status} = {status} + 1 WHERE broadcast_id = ?', (broadcast_id,))
+        conn.commit()
+
+    try:
+        cursor.execute('''
+        SELECT segment, text, from_chat_id, message_id, last_user_id
+        FROM broadcasts WHERE broadcast_id = ?
+        ''', (broadcast_id,))
+        segment, text, from_chat_id, message_id, last_user_id = cursor.fetchone()
+
+        while True:
+            # Рассылку могли отменить на другом экземпляре
+            cursor.execute('SELECT status FROM broadcasts WHERE broadcast_id = ?', (broadcast_id,))
+            if cursor.fetchone()[0] != 'running':
+                break
+
+            user_ids = fetch_broadcast_batch(cursor, broadcast_id, segment, last_user_id)
+            if not user_ids:
+                break
+
+            await asyncio.gather(*(deliver(user_id) for user_id in user_ids))
+
+            last_user_id = user_ids[-1]
+            cursor.execute(
+                'UPDATE broadcasts SET last_user_id = ? WHERE broadcast_id = ?',
+                (last_user_id, broadcast_id)
+            )
+            conn.commit()
+
+        cursor.execute('''
+        UPDATE broadcasts SET status = 'done', finished_at = ? WHERE broadcast_id = ? AND status = 'running'
+        ''', (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), broadcast_id))
+        finished = cursor.rowcount
+        conn.commit()
+        cursor.execute('SELECT sent, failed, blocked FROM broadcasts WHERE broadcast_id = ?', (broadcast_id,))
+        sent, failed, blocked = cursor.fetchone()
+    except Exception as e:
+        logger.exception(
+            "Рассылка #%s прервана: %s", broadcast_id, e,
+            extra={'broadcast_id': broadcast_id, 'stage': 'broadcast'}
+        )
+        await notify_broadcast_failed(broadcast_id, e)
+        return
+    finally:
+        conn.close()
+        active_broadcasts.pop(broadcast_id, None)
+
+    # Рассылку отменили, пока отправлялась последняя пачка
+    if not finished:
+        return
+
+    await bot.send_message(
+        ADMIN_ID,
+        f"📣 Рассылка #{broadcast_id} завершена\n"
+        f"Доставлено: {sent}\nОшибок: {failed}\nЗаблокировали бота: {blocked}"
+    )
+
+
+async def notify_broadcast_failed(broadcast_id, error):
+    """Помечает рассылку прерванной и предлагает администратору продолжить ее"""
+    try:
+        conn = sqlite3.connect(DB_PATH)
+        conn.execute(
+            "UPDATE broadcasts SET status = 'failed' WHERE broadcast_id = ? AND status = 'running'",
+            (broadcast_id,)
+        )
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        logger.error("Ошибка при обновлении статуса рассылки #%s: %s", broadcast_id, e,
+                     extra={'broadcast_id': broadcast_id, 'stage': 'broadcast'})
+
+    keyboard = InlineKeyboardBuilder()
+    keyboard.add(InlineKeyboardButton(
+        text="🔁 Продолжить",
+        callback_data=f"broadcast_resume_{broadcast_id}"
+    ))
+
+    try:
+        await bot.send_message(
+            ADMIN_ID,
+            f"⚠️ Рассылка #{broadcast_id} прервана из-за ошибки: {error}\n"
+            "Уже доставленные сообщения повторно отправлены не будут.",
+            reply_markup=keyboard.as_markup()
+        )
+    except Exception as e:
+        logger.error("Ошибка при уведомлении о рассылке #%s: %s", broadcast_id, e,
+                     extra={'broadcast_id': broadcast_id, 'stage': 'broadcast'})
+
+
+def start_broadcast(broadcast_id):
+    if broadcast_id not in active_broadcasts:
+        active_broadcasts[broadcast_id] = run_in_background(run_broadcast(broadcast_id))
+
+
+def resume_broadcasts():
+    """Продолжает рассылки, прерванные перезапуском бота"""
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    cursor.execute("SELECT broadcast_id FROM broadcasts WHERE status = 'running'")
+    broadcast_ids = [row[0] for row in cursor.fetchall()]
+    conn.close()
+
+    for broadcast_id in broadcast_ids:
+        if broadcast_id not in active_broadcasts:
+            logger.info("Продолжаем рассылку #%s", broadcast_id, extra={'broadcast_id': broadcast_id})
+            start_broadcast(broadcast_id)
+
+
+@dp.message(Command("broadcast"))
+async def broadcast_command(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("Доступ запрещен")
+        return
+
+    segments = ', '.join(BROADCAST_SEGMENTS)
+    usage = (
+        "Используйте формат:\n/broadcast segment\nтекст сообщения\n\n"
+        "или ответьте командой /broadcast segment на сообщение, которое нужно разослать.\n"
+        f"Сегменты: {segments}"
+    )
+
+    command_line, _, text = message.text.partition('\n')
+    args = command_line.split()
+    text = text.strip()
+    source = message.reply_to_message
+
+    if len(args) != 2 or args[1] not in BROADCAST_SEGMENTS or not (text or source):
+        await message.answer(usage)
+        return
+
+    segment = args[1]
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    if text:
+        cursor.execute('INSERT INTO broadcasts (segment, text) VALUES (?, ?)', (segment, text))
+    else:
+        cursor.execute('''
+        INSERT INTO broadcasts (segment, from_chat_id, message_id) VALUES (?, ?, ?)
+        ''', (segment, message.chat.id, source.message_id))
+    broadcast_id = cursor.lastrowid
+    conn.commit()
+    conn.close()
+
+    keyboard = InlineKeyboardBuilder()
+    keyboard.add(InlineKeyboardButton(
+        text="🚀 Запустить",
+        callback_data=f"broadcast_start_{broadcast_id}"
+    ))
+    keyboard.add(InlineKeyboardButton(
+        text="❌ Отменить",
+        callback_data=f"broadcast_cancel_{broadcast_id}"
+    ))
+
+    await message.answer(
+        f"📣 Рассылка #{broadcast_id}\n"
+        f"Сегмент: {segment}\n"
+        f"Получателей: {count_segment(segment)}\n\n"
+        "Запустить?",
+        reply_markup=keyboard.as_markup()
+    )
+
+
+@dp.callback_query(F.data.startswith("broadcast_start_"))
+async def broadcast_start(callback: types.CallbackQuery):
+    if callback.from_user.id != ADMIN_ID:
+        await callback.answer("Доступ запрещен", show_alert=True)
+        return
+
+    broadcast_id = int(callback.data.split('_')[2])
+
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    cursor.execute('''
+    UPDATE broadcasts SET status = 'running' WHERE broadcast_id = ? AND status = 'draft'
+    ''', (broadcast_id,))
+    started = cursor.rowcount
+    conn.commit()
+    conn.close()
+
+    if not started:
+        await callback.answer("Рассылка уже запущена или отменена", show_alert=True)
+        return
+
+    # Рассылки выполняет лидер; на остальных экземплярах ее подхватит broadcast_watcher
+    if is_leader:
+        start_broadcast(broadcast_id)
+    await callback.message.edit_text(
+        f"🚀 Рассылка #{broadcast_id} запущена. Прогресс: /broadcast_status {broadcast_id}"
+    )
+    await callback.answer()
+
+
+@dp.callback_query(F.data.startswith("broadcast_resume_"))
+async def broadcast_resume(callback: types.CallbackQuery):
+    if callback.from_user.id != ADMIN_ID:
+        await callback.answer("Доступ запрещен", show_alert=True)
+        return
+
+    broadcast_id = int(callback.data.split('_')[2])
+
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    cursor.execute('''
+    UPDATE broadcasts SET status = 'running' WHERE broadcast_id = ? AND status = 'failed'
+    ''', (broadcast_id,))
+    resumed = cursor.rowcount
+    conn.commit()
+    conn.close()
+
+    if not resumed:
+        await callback.answer("Рассылка уже идет, завершена или отменена", show_alert=True)
+        return
+
+    # Рассылки выполняет лидер; на остальных экземплярах ее подхватит broadcast_watcher
+    if is_leader:
+        start_broadcast(broadcast_id)
+    await callback.message.edit_text(
+        f"🔁 Рассылка #{broadcast_id} продолжена. Прогресс: /broadcast_status {broadcast_id}"
+    )
+    await callback.answer()
+
+
+@dp.callback_query(F.data.startswith("broadcast_cancel_"))
+async def broadcast_cancel(callback: types.CallbackQuery):
+    if callback.from_user.id != ADMIN_ID:
+        await callback.answer("Доступ запрещен", show_alert=True)
+        return
+
+    broadcast_id = int(callback.data.split('_')[2])
+
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    cursor.execute('''
+    UPDATE broadcasts SET status = 'cancelled' WHERE broadcast_id = ? AND status IN ('draft', 'running', 'failed')
+    ''', (broadcast_id,))
+    conn.commit()
+    conn.close()
+
+    task = active_broadcasts.pop(broadcast_id, None)
+    if task:
+        task.cancel()
+
+    await callback.message.edit_text(f"❌ Рассылка #{broadcast_id} отменена")
+    await callback.answer()
+
+
+@dp.message(Command("broadcast_status"))
+async def broadcast_status(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("Доступ запрещен")
+        return
+
+    args = message.text.split()
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    if len(args) > 1 and args[1].isdigit():
+        cursor.execute('''
+        SELECT broadcast_id, segment, status, sent, failed, blocked FROM broadcasts
+        WHERE broadcast_id = ?
+        ''', (int(args[1]),))
+    else:
+        cursor.execute('''
+        SELECT broadcast_id, segment, status, sent, failed, blocked FROM broadcasts
+        ORDER BY broadcast_id DESC LIMIT 5
+        ''')
+    broadcasts = cursor.fetchall()
+    conn.close()
+
+    if not broadcasts:
+        await message.answer("Рассылок нет")
+        return
+
+    keyboard = InlineKeyboardBuilder()
+    text = "📣 Рассылки:\n\n"
+    for broadcast_id, segment, status, sent, failed, blocked in broadcasts:
+        text += (
+            f"#{broadcast_id} [{segment}] {status}\n"
+            f"Доставлено: {sent} | Ошибок: {failed} | Заблокировали: {blocked}\n\n"
+        )
+        if status == 'running':
+            keyboard.add(InlineKeyboardButton(
+                text=f"⏹ Остановить #{broadcast_id}",
+                callback_data=f"broadcast_cancel_{broadcast_id}"
+            ))
+
+    await message.answer(text, reply_markup=keyboard.as_markup())
+
+
+# === ПРОФИЛИРОВАНИЕ ===
+class SampledStats:
+    """Статистика сэмплов в формате, который понимает pstats.Stats"""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class SamplingProfiler:
+    """Снимает стек потока event loop из отдельного потока и отмечает блокировки цикла"""
+
+    def __init__(self, thread_id, interval, block_threshold):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.block_threshold = block_threshold
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='sampling-profiler', daemon=True)
+        self.samples = 0
+        self.collapsed = {}  # "f1;f2;f3" -> число сэмплов
+        self.stats = {}  # (файл, строка, функция) -> [cc, nc, tt, ct, {caller: [cc, nc, tt, ct]}]
+        self.last_tick = time.monotonic()
+        self.blocks = []  # (длительность, стек) блокировок event loop
+        self.current_block = None
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+        self.finish_block()
+
+    def tick(self):
+        """Вызывается из event loop, пока он не заблокирован"""
+        self.last_tick = time.monotonic()
+        self.finish_block()
+
+    def finish_block(self):
+        block, self.current_block = self.current_block, None
+        if block:
+            self.blocks.append((time.monotonic() - block[0], block[1]))
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+
+            stack = []
+            while frame is not None:
+                stack.append(frame.f_code)
+                frame = frame.f_back
+            stack.reverse()
+            self.add_sample(stack)
+
+            lag = time.monotonic() - self.last_tick
+            if lag > self.block_threshold and self.current_block is None:
+                self.current_block = (self.last_tick, self.collapse(stack))
+
+    @staticmethod
+    def frame_label(code):
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def collapse(self, stack):
+        return ';'.join(self.frame_label(code) for code in stack)
+
+    def add_sample(self, stack):
+        self.samples += 1
+        key = self.collapse(stack)
+        self.collapsed[key] = self.collapsed.get(key, 0) + 1
+
+        seen = set()
+        caller = None
+        for i, code in enumerate(stack):
+            func = (code.co_filename, code.co_firstlineno, code.co_name)
+            entry = self.stats.setdefault(func, [0, 0, 0.0, 0.0, {}])
+            if func not in seen:
+                # Рекурсивные вызовы учитываем в кумулятивном времени один раз
+                seen.add(func)
+                entry[0] += 1
+                entry[3] += self.interval
+            entry[1] += 1
+            if i == len(stack) - 1:
+                entry[2] += self.interval
+            if caller is not None:
+                edge = entry[4].setdefault(caller, [0, 0, 0.0, 0.0])
+                edge[0] += 1
+                edge[1] += 1
+                edge[3] += self.interval
+                if i == len(stack) - 1:
+                    edge[2] += self.interval
+            caller = func
+
+    def pstats_dump(self):
+        stats = {
+            func: (cc, nc, tt, ct, {caller: tuple(edge) for caller, edge in callers.items()})
+            for func, (cc, nc, tt, ct, callers) in self.stats.items()
+        }
+        return pstats.Stats(SampledStats(stats))
+
+
+profiling_active = False
+
+
+async def run_profile(chat_id, seconds, debug_loop=False):
+    """Профилирует бота seconds секунд и отправляет результаты администратору
+
+    Режим отладки asyncio (debug_loop) сохраняет traceback для каждого колбэка и заметно
+    замедляет бота, поэтому включается только явно; блокировки loop видны и без него.
+    """
+    loop = asyncio.get_running_loop()
+    profiler = SamplingProfiler(threading.get_ident(), PROFILE_SAMPLE_INTERVAL, PROFILE_BLOCK_THRESHOLD)
+
+    # Медленные колбэки event loop asyncio пишет в свой логгер в режиме отладки
+    slow_callbacks = []
+
+    class SlowCallbackHandler(logging.Handler):
+        def emit(self, record):
+            if len(slow_callbacks) < 1000:
+                slow_callbacks.append(record.getMessage())
+
+    asyncio_logger = logging.getLogger('asyncio')
+    slow_handler = SlowCallbackHandler(logging.WARNING)
+    debug, slow_duration = loop.get_debug(), loop.slow_callback_duration
+    if debug_loop:
+        asyncio_logger.addHandler(slow_handler)
+        loop.set_debug(True)
+        loop.slow_callback_duration = PROFILE_BLOCK_THRESHOLD
+
+    logger.info("Профилирование запущено на %s сек", seconds, extra={'stage': 'profile'})
+    started = time.monotonic()
+    profiler.start()
+    try:
+        while time.monotonic() - started < seconds:
+            profiler.tick()
+            await asyncio.sleep(PROFILE_SAMPLE_INTERVAL)
+    finally:
+        profiler.stop()
+        loop.set_debug(debug)
+        loop.slow_callback_duration = slow_duration
+        asyncio_logger.removeHandler(slow_handler)
+        tasks = asyncio.all_tasks()
+
+    stats = profiler.pstats_dump()
+    report = io.StringIO()
+    report.write(
+        f"Профиль за {seconds} сек, сэмплов: {profiler.samples}, "
+        f"интервал {PROFILE_SAMPLE_INTERVAL * 1000:.0f} мс\n\n"
+    )
+
+    report.write(f"=== Блокировки event loop дольше {PROFILE_BLOCK_THRESHOLD * 1000:.0f} мс: {len(profiler.blocks)} ===\n")
+    for duration, stack in sorted(profiler.blocks, reverse=True)[:20]:
+        report.write(f"{duration * 1000:.0f} мс: {stack}\n")
+
+    if debug_loop:
+        report.write(f"\n=== Медленные колбэки asyncio: {len(slow_callbacks)} ===\n")
+        for line in slow_callbacks[:50]:
+            report.write(line + "\n")
+
+    report.write(f"\n=== Задачи asyncio: {len(tasks)} ===\n")
+    for task in sorted(tasks, key=lambda t: t.get_name()):
+        frames = task.get_stack(limit=1)
+        where = f"{frames[0].f_code.co_name}:{frames[0].f_lineno}" if frames else "-"
+        report.write(f"{task.get_name()}: {task.get_coro().__qualname__} @ {where}\n")
+
+    report.write("\n=== Функции по собственному времени ===\n")
+    stats.stream = report
+    stats.sort_stats('tottime').print_stats(30)
+    report.write("\n=== Функции по кумулятивному времени ===\n")
+    stats.sort_stats('cumulative').print_stats(30)
+
+    # Тот же формат, что пишет pstats.Stats.dump_stats
+    pstats_data = marshal.dumps(stats.stats)
+
+    collapsed = '\n'.join(f"{stack} {count}" for stack, count in profiler.collapsed.items())
+    stamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+
+    await bot.send_document(
+        chat_id,
+        BufferedInputFile(report.getvalue().encode('utf-8'), filename=f"profile_{stamp}.txt"),
+        caption=f"📈 Профиль за {seconds} сек, блокировок event loop: {len(profiler.blocks)}"
+    )
+    await bot.send_document(
+        chat_id,
+        BufferedInputFile(pstats_data, filename=f"profile_{stamp}.pstats"),
+        caption="pstats (snakeviz, python -m pstats)"
+    )
+    await bot.send_document(
+        chat_id,
+        BufferedInputFile(collapsed.encode('utf-8'), filename=f"profile_{stamp}.collapsed"),
+        caption="Свернутые стеки для flamegraph.pl / speedscope"
+    )
+
+
+def finish_profile(task):
+    """Снимает флаг профилирования, как бы ни завершилась сессия"""
+    global profiling_active
+    profiling_active = False
+    if not task.cancelled() and task.exception():
+        logger.error("Ошибка профилирования", exc_info=task.exception(), extra={'stage': 'profile'})
+
+
+@dp.message(Command("profile"))
+async def cmd_profile(message: types.Message):
+    global profiling_active
+
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("Доступ запрещен")
+        return
+
+    # Формат команды: /profile [seconds] [debug]
+    args = message.text.split()
+    try:
+        seconds = int(args[1]) if len(args) > 1 else 30
+        if not 1 <= seconds <= PROFILE_MAX_SECONDS or len(args) > 3:
+            raise ValueError
+        debug_loop = len(args) > 2
+        if debug_loop and args[2] != 'debug':
+            raise ValueError
+    except ValueError:
+        await message.answer(f"Используйте формат: /profile [1-{PROFILE_MAX_SECONDS} сек] [debug]")
+        return
+
+    if profiling_active:
+        await message.answer("Профилирование уже запущено")
+        return
+
+    profiling_active = True
+    task = run_in_background(run_profile(message.chat.id, seconds, debug_loop))
+    task.add_done_callback(finish_profile)
+    mode = " в режиме отладки asyncio" if debug_loop else ""
+    await message.answer(f"⏱ Профилирование запущено на {seconds} сек{mode}")
+
+
+# === БЫСТРЫЙ ЗАПУСК И ТЕПЛЫЙ ПЕРЕЗАПУСК ===
+def set_startup_status(stage, status):
+    startup_status[stage] = status
+    logger.info("Запуск: %s - %s", stage, status, extra={'stage': 'startup'})
+    if all(value == 'ready' for value in startup_status.values()):
+        logger.info("Бот готов", extra={'stage': 'startup', 'duration': round(time.monotonic() - started_at, 3)})
+
+
+def run_startup_task(stage, coro):
+    """Запускает этап запуска фоновой задачей и отслеживает его готовность для /health"""
+    startup_status[stage] = 'running'
+
+    async def tracked():
+        try:
+            await coro
+        except Exception as e:
+            set_startup_status(stage, f'ошибка: {e}')
+            logger.exception("Ошибка этапа запуска %s: %s", stage, e, extra={'stage': 'startup'})
+        else:
+            set_startup_status(stage, 'ready')
+
+    return run_in_background(tracked())
+
+
+async def init_db_async():
+    await asyncio.to_thread(init_db)
+    db_ready.set()
+
+
+@dp.update.outer_middleware()
+async def wait_for_db(handler, event, data):
+    """Обновления принимаются сразу, но обработчики ждут проверки схемы БД (обычно миллисекунды)"""
+    if not db_ready.is_set():
+        await db_ready.wait()
+    return await handler(event, data)
+
+
+def build_snapshot():
+    """Собирает теплое состояние: курсор ингестии, обработанные алерты, статистику и доступы"""
+    now = datetime.now()
+    return {
+        'saved_at': now.strftime('%Y-%m-%d %H:%M:%S'),
+        'known_alerts_date': known_alerts_date,
+        'known_alerts': list(known_alerts),
+        'last_alert_datetime': last_alert_datetime.strftime('%Y-%m-%d %H:%M:%S') if last_alert_datetime else None,
+        'alert_stats': alert_stats.to_dict(),
+        # known_alerts помечает алерты уже при постановке в очередь, поэтому сохраняем и саму очередь
+        'pending_alerts': [
+            {key: value for key, value in item[4].items() if key not in ('datetime', 'claimed')}
+            for item in alert_queue.heap
+        ],
+        'entitlements': {
+            str(user_id): [end.strftime('%Y-%m-%d %H:%M:%S'), checked_at, version]
+            for user_id, (end, checked_at, version) in entitlement_cache.items() if end > now
+        },
+    }
+
+
+def write_snapshot(data):
+    # Пишем во временный файл и подменяем, чтобы не оставить поврежденный снимок
+    tmp_path = f'{SNAPSHOT_PATH}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(data)
+    os.replace(tmp_path, SNAPSHOT_PATH)
+
+
+async def save_snapshot():
+    try:
+        # Сериализуем в потоке event loop (состояние меняется только в нем), пишем на диск - в отдельном
+        data = json.dumps(build_snapshot(), ensure_ascii=False)
+        await asyncio.to_thread(write_snapshot, data)
+    except Exception as e:
+        logger.warning("Ошибка при сохранении снимка состояния: %s", e, extra={'stage': 'snapshot'})
+
+
+def restore_snapshot():
+    """Восстанавливает теплое состояние, если снимок относится к текущему торговому дню"""
+    global known_alerts_date, last_alert_datetime
+
+    try:
+        with open(SNAPSHOT_PATH, encoding='utf-8') as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return
+    except Exception as e:
+        logger.warning("Снимок состояния не прочитан: %s", e, extra={'stage': 'snapshot'})
+        return
+
+    today = datetime.now().strftime('%Y-%m-%d')
+    if data.get('known_alerts_date') == today:
+        known_alerts_date = today
+        known_alerts.update(data.get('known_alerts', []))
+        if data.get('last_alert_datetime'):
+            last_alert_datetime = datetime.strptime(data['last_alert_datetime'], '%Y-%m-%d %H:%M:%S')
+        alert_stats.load_dict(data.get('alert_stats', {}))
+
+        # Отправлять очередь будет только лидер; уже отправленное отсеет claim_alert
+        if is_leader:
+            for alert in data.get('pending_alerts', []):
+                alert['datetime'] = datetime.strptime(f"{alert['date']} {alert['time']}", '%Y-%m-%d %H:%M:%S')
+                alert_queue.put(alert)
+
+    now = datetime.now()
+    # Записи сверяются с версией доступа при каждом использовании, поэтому снимку другого экземпляра можно доверять
+    for user_id, entry in data.get('entitlements', {}).items():
+        if len(entry) != 3:
+            continue  # Снимок старого формата, без версии доступа
+        end, checked_at, version = entry
+        end = datetime.strptime(end, '%Y-%m-%d %H:%M:%S')
+        if end > now:
+            entitlement_cache[int(user_id)] = (end, checked_at, version)
+
+    logger.info(
+        "Восстановлен снимок состояния от %s: алертов %s, в очереди %s, доступов %s",
+        data.get('saved_at'), len(known_alerts), len(alert_queue), len(entitlement_cache),
+        extra={'stage': 'snapshot'}
+    )
+
+
+@dp.message(Command("health"))
+async def cmd_health(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("Доступ запрещен")
+        return
+
+    text = (
+        f"🩺 Работает {int(time.monotonic() - started_at)} сек\n"
+        f"Экземпляр: {INSTANCE_ID} ({'лидер' if is_leader else 'резерв'})\n\n"
+    )
+    for stage, status in startup_status.items():
+        icon = '✅' if status == 'ready' else '⏳' if status == 'running' else '❌'
+        text += f"{icon} {stage}: {status}\n"
+    text += (
+        f"\nОчередь алертов: {len(alert_queue)}\n"
+        f"Фоновых задач: {len(background_tasks)}\n"
+        f"Потеряно записей лога при переполнении очереди: {log_handler.dropped_total}\n"
+        f"Последний алерт: {last_alert_datetime or '-'}"
+    )
+    await message.answer(text)
+
+
+# === НЕСКОЛЬКО ЭКЗЕМПЛЯРОВ: ВЫБОР ЛИДЕРА ===
+# Обработчики работают на всех экземплярах, а опрос MOEX, отправка в канал, проверка подписок
+# и рассылки - только на лидере. Лидер держит аренду в общей базе и продлевает ее каждые
+# LEADER_RENEW_INTERVAL секунд; если он пропал, аренду забирает другой через LEADER_LEASE_TTL.
+is_leader = False
+leader_tasks = set()  # Задачи, которые выполняются только на лидере
+takeover_recheck = False  # После захвата лидерства проверить, все ли свежие алерты отправлены
+
+
+def acquire_lease():
+    """Захватывает свободную или продлевает свою аренду; True - лидер этот экземпляр"""
+    now = time.time()
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    cursor.execute('''
+    INSERT INTO leader_lease (name, holder, expires_at) VALUES ('pollers', ?, ?)
+    ON CONFLICT (name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at
+    WHERE leader_lease.holder = excluded.holder OR leader_lease.expires_at < ?
+    ''', (INSTANCE_ID, now + LEADER_LEASE_TTL, now))
+    acquired = cursor.rowcount > 0
+    conn.commit()
+    conn.close()
+    return acquired
+
+
+def release_lease():
+    """Освобождает аренду при остановке, чтобы резервный экземпляр не ждал ее истечения"""
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM leader_lease WHERE name = 'pollers' AND holder = ?", (INSTANCE_ID,))
+    conn.commit()
+    conn.close()
+
+
+def alert_key(alert):
+    # ID алерта не содержит даты, а sent_alerts хранится дольше одного дня
+    return f"{alert['datetime']:%Y-%m-%d}_{alert['ticker']}_{alert['time']}_{alert['alert_type']}"
+
+
+def claim_alert(alert):
+    """Закрепляет отправку алерта; False - его уже отправили (или сбросили) раньше
+
+    Запись делается до отправки: если лидер упадет между ними, алерт будет потерян, но не задвоен.
+    """
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    cursor.execute('''
+    INSERT OR IGNORE INTO sent_alerts (alert_key, holder, claimed_at) VALUES (?, ?, ?)
+    ''', (alert_key(alert), INSTANCE_ID, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+    claimed = cursor.rowcount > 0
+    conn.commit()
+    conn.close()
+    return claimed
+
+
+def record_shed_alerts(alerts):
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    claimed_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    cursor.executemany('''
+    INSERT OR IGNORE INTO sent_alerts (alert_key, holder, claimed_at, status) VALUES (?, ?, ?, 'shed')
+    ''', [(alert_key(alert), INSTANCE_ID, claimed_at) for alert in alerts])
+    conn.commit()
+    conn.close()
+
+
+def load_claimed_alerts(date):
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    cursor.execute('SELECT alert_key FROM sent_alerts WHERE alert_key LIKE ?', (f'{date}_%',))
+    claimed = {row[0] for row in cursor.fetchall()}
+    conn.close()
+    return claimed
+
+
+def prune_sent_alerts(date):
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    cursor.execute('DELETE FROM sent_alerts WHERE claimed_at < ?', (date,))
+    conn.commit()
+    conn.close()
+
+
+async def broadcast_watcher():
+    """Подхватывает рассылки, запущенные с любого экземпляра, и прерванные прежним лидером"""
+    while True:
+        try:
+            resume_broadcasts()
+        except Exception as e:
+            logger.warning("Ошибка при проверке рассылок: %s", e, extra={'stage': 'broadcast'})
+        await asyncio.sleep(LEADER_RENEW_INTERVAL)
+
+
+def become_leader():
+    global is_leader, takeover_recheck
+
+    is_leader = True
+    takeover_recheck = True
+    logger.info("Экземпляр %s стал лидером", INSTANCE_ID, extra={'stage': 'leader'})
+
+    # Теплое состояние прежнего лидера из общего снимка
+    restore_snapshot()
+
+    startup_status['first_poll'] = 'running'
+    leader_tasks.update({
+        run_startup_task('expiry_catchup', check_expired_subscriptions()),
+        run_in_background(scheduled_checker()),  # For alerts
+        run_in_background(alert_sender()),  # Alert delivery queue
+        run_in_background(subscription_checker()),  # For subscriptions
+        run_in_background(broadcast_watcher()),  # Рассылки
+        run_in_background(instruments_refresher()),  # Справочник инструментов
+    })
+
+
+def step_down():
+    global is_leader
+
+    is_leader = False
+    logger.warning("Экземпляр %s потерял лидерство", INSTANCE_ID, extra={'stage': 'leader'})
+
+    # Прогресс рассылок сохранен в базе, неотправленные алерты новый лидер найдет по sent_alerts
+    for task in [*leader_tasks, *active_broadcasts.values()]:
+        task.cancel()
+    leader_tasks.clear()
+    alert_queue.clear()
+    startup_status.pop('first_poll', None)
+    startup_status.pop('expiry_catchup', None)
+
+
+async def leader_elector():
+    """Продлевает аренду лидера или ждет, пока она освободится"""
+    await db_ready.wait()
+    renewed_at = 0.0
+    while True:
+        try:
+            acquired = await asyncio.to_thread(acquire_lease)
+            if acquired:
+                renewed_at = time.monotonic()
+        except Exception as e:
+            logger.warning("Ошибка продления аренды лидера: %s", e, extra={'stage': 'leader'})
+            # Уступаем раньше, чем аренда истечет и ее сможет забрать другой экземпляр
+            acquired = is_leader and time.monotonic() - renewed_at < LEADER_LEASE_TTL - LEADER_RENEW_INTERVAL
+
+        if acquired and not is_leader:
+            become_leader()
+        elif not acquired and is_leader:
+            step_down()
+        await asyncio.sleep(LEADER_RENEW_INTERVAL)
+
+
+def read_snapshot_stats():
+    with open(SNAPSHOT_PATH, encoding='utf-8') as f:
+        data = json.load(f)
+    return data.get('known_alerts_date'), data.get('alert_stats', {})
+
+
+async def follower_sync():
+    """Резервные экземпляры берут статистику для /stats и /top из снимка лидера"""
+    while True:
+        await asyncio.sleep(check_interval)
+        if is_leader:
+            continue
+        try:
+            date, stats = await asyncio.to_thread(read_snapshot_stats)
+        except FileNotFoundError:
+            continue
+        except Exception as e:
+            logger.warning("Снимок лидера не прочитан: %s", e, extra={'stage': 'snapshot'})
+            continue
+        if date == datetime.now().strftime('%Y-%m-%d'):
+            alert_stats.clear()
+            alert_stats.load_dict(stats)
+
+
+async def run_webhook():
+    """Режим webhook: getUpdates допускает только одного получателя, а webhook - несколько экземпляров за балансировщиком"""
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET or None).register(app, path=WEBHOOK_PATH)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+        # Все экземпляры ставят один и тот же webhook, повторный вызов ничего не меняет
+        await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET or None)
+        logger.info("Webhook %s, слушаем %s:%s%s", WEBHOOK_URL, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+# === ЗАПУСК БОТА ===
+async def on_startup():
+    """Ничего не ждет: тяжелая работа идет фоновыми задачами, polling начинается сразу"""
+    # Теплое состояние из снимка - до первого опроса MOEX
+    restore_snapshot()
+
+    run_startup_task('schema', init_db_async())
+    run_startup_task('instruments', init_instruments())
+
+    # Опрос MOEX, подписки и рассылки запустятся, когда этот экземпляр получит аренду лидера
+    run_in_background(leader_elector())
+    run_in_background(follower_sync())
+
+    logger.info("Бот запущен, экземпляр %s", INSTANCE_ID)
+
+
+async def main():
+    await on_startup()
+    try:
+        if WEBHOOK_URL:
+            await run_webhook()
+        else:
+            await dp.start_polling(bot)
+    finally:
+        # Снимок пишет только лидер: резервный экземпляр затер бы его устаревшим состоянием
+        if is_leader:
+            await save_snapshot()
+            await asyncio.to_thread(release_lease)
 
 
 if __name__ == '__main__':